@@ -1,7 +1,8 @@
 import argparse
 import atexit
 
-from .common import GlassballError, ConfigurationError, log_error, log_message, log_handlers
+from . import common
+from .common import GlassballError, ConfigurationError, Profiler, PROFILE_PHASES, log_error, log_message, log_handlers
 
 from . import cmd_init
 from . import cmd_list
@@ -10,6 +11,9 @@ from . import cmd_build
 from . import cmd_rawfeed
 from . import cmd_opmlimport
 from . import cmd_add
+from . import cmd_merge
+from . import cmd_media
+from . import cmd_loadtest
 
 
 # An explicit list of modules for which we should register commands. These
@@ -23,6 +27,9 @@ command_modules = [
     cmd_rawfeed,
     cmd_opmlimport,
     cmd_add,
+    cmd_merge,
+    cmd_media,
+    cmd_loadtest,
 ]
 
 
@@ -33,6 +40,8 @@ if __name__ == '__main__':
     common_group.add_argument('-c', '--config', default='feeds.ini', help='The configuration file with which to work')
     common_group.add_argument('-q', '--quiet', action='store_true', help='Prevent and messages and errors from appearing in the output')
     common_group.add_argument('-l', '--log', default=None, help='Log all messages and errors to the given file')
+    common_group.add_argument('--profile', default=None, metavar='PREFIX', help='Profile the command, writing PREFIX.pstats and PREFIX.collapsed (collapsed stacks for flamegraphs)')
+    common_group.add_argument('--profile-phase', default=None, choices=PROFILE_PHASES, help='Only profile the given phase of work (without a fetch cache, fetch includes parse)')
 
     # Construct the "root" argument parser, add each command we know about to
     # it, and parse the arguments
@@ -57,9 +66,21 @@ if __name__ == '__main__':
         atexit.register(log_file.close)
         log_handlers.append(lambda e: print(e, file=log_file))
 
+    # Set up profiling as requested, either for one phase or the whole command
+    if options.profile:
+        common.active_profiler = Profiler(phase=options.profile_phase)
+        if not options.profile_phase:
+            common.active_profiler.enable()
+
     # With all set-up done, run the command function and handle errors
     try:
         command_func(options)
     except GlassballError as e:
         log_error(str(e), exception=e)
         args.exit(2)
+    finally:
+        if common.active_profiler:
+            if not options.profile_phase:
+                common.active_profiler.disable()
+            for profile_file in common.active_profiler.write(options.profile):
+                log_message("Wrote profile '{}'".format(profile_file))
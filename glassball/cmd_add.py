@@ -1,9 +1,12 @@
+import concurrent.futures
 import configparser
+import socket
 import sys
 
 import feedparser
 
-from .common import Configuration, CommandError, slugify, find_free_name, log_error, log_message
+from .common import Configuration, CommandError, slugify, NameAllocator, log_error, log_message
+from .cmd_update import update_feed
 
 
 def register_command(commands, common_args):
@@ -12,51 +15,65 @@ def register_command(commands, common_args):
     args.add_argument('-f', '--force', action='store_true', help='Force snippet creation even if the URL is already configured')
     args.add_argument('--no-redirect', action='store_true', help='use the given URL verbatim, do not follow redirects to determine that actual URL to use')
     args.add_argument('-w', '--write-config', action='store_true', help='Writes the import feeds directly to the configuration')
+    add_probe_arguments(args)
     args.set_defaults(command_func=command_add)
 
 
+# Adds the arguments that control feed probing to a command's argument parser
+def add_probe_arguments(args):
+    args.add_argument('-j', '--jobs', type=int, default=8, help='The number of feeds to retrieve concurrently')
+    args.add_argument('--timeout', type=float, default=30, help='The number of seconds to wait for a feed to respond')
+    args.add_argument('--seed', action='store_true', help='Store the items of the retrieved feeds in the database (requires writing the configuration)')
+
+
 def command_add(options):
     # Already known feed URLs and names
     known_urls = {}
-    known_names = set()
+    known_names = NameAllocator()
 
     # If we can use the given configuration we update the known URLs and names
     if Configuration.exists(options.config):
         config = Configuration(options.config)
-        known_names = {feed.key for feed in config.feeds}
+        known_names = NameAllocator(feed.key for feed in config.feeds)
         for feed in config.feeds:
             known_urls.setdefault(feed.url, [])
             known_urls[feed.url].append(feed)
 
-    result = configparser.ConfigParser(interpolation=None)
+    if options.seed and not options.write_config:
+        raise CommandError("Cannot seed the database with added feeds without writing them to the configuration")
+
+    # Prevent double registrations during normal operations
+    urls = []
     for url in options.url:
-        # Prevent double registrations during normal operations
         if url in known_urls and not options.force:
             print("The feed URL '{}' is already configured as {}".format(url, ", ".join(repr(feed.key) for feed in known_urls[url])))
             continue
+        urls.append(url)
+
+    # Retrieve feed content for all feeds at once
+    probes = probe_feeds(urls, jobs=options.jobs, timeout=options.timeout)
+    print_probe_summary(probes)
 
-        # Retrieve feed content
-        feed = feedparser.parse(url)
-        if feed.bozo:
-            print("Cannot add feed: the feed at '{}' is unretrievable, malformed, or otherwise not in good shape.".format(url))
+    result = configparser.ConfigParser(interpolation=None)
+    seed_data = {}
+    for probe in probes:
+        if probe.problem:
             continue
 
         # If we receive a redirection here, we want to use the new location
-        if 'status' in feed and 300 <= feed.status < 400 and not options.no_redirect:
-            print("Using redirection URL '{}'".format(feed.href))
-            url = feed.href
+        url = probe.url if options.no_redirect else probe.resolved_url
 
         # Get necessary information from retrieved feed
-        title = feed.feed.get('title', 'untitled')
+        title = probe.title
 
-        name = find_free_name(slugify(title), known_names)
-        known_names.add(name)
+        name = known_names.allocate(slugify(title))
         key = 'feed:' + name
 
         # Set up configuration snippet for output
         result[key] = {}
         result[key]['url'] = url
         result[key]['title'] = title
+        seed_data[name] = probe.feed_data
 
     # Write out snippet to requested target
     if options.write_config:
@@ -67,3 +84,102 @@ def command_add(options):
             result.write(f)
     else:
         result.write(sys.stdout)
+
+    # Store the retrieved items if requested
+    if options.seed:
+        seed_database(Configuration(options.config), seed_data)
+
+
+#
+# Feed probing
+#
+
+class ProbeResult:
+    def __init__(self, url, feed_data=None, error=None):
+        self.url = url
+        self.feed_data = feed_data
+        self.error = error
+
+    @property
+    def status(self):
+        if self.feed_data is None:
+            return None
+        return self.feed_data.get('status')
+
+    @property
+    def redirected(self):
+        return self.status is not None and 300 <= self.status < 400
+
+    @property
+    def resolved_url(self):
+        return self.feed_data.href if self.redirected else self.url
+
+    @property
+    def title(self):
+        return self.feed_data.feed.get('title', 'untitled')
+
+    # A short description of why the feed cannot be used, or None if the feed
+    # is usable
+    @property
+    def problem(self):
+        if self.error is not None:
+            return "unretrievable: {}".format(self.error)
+        if self.status is None:
+            return "unretrievable: {}".format(self.feed_data.get('bozo_exception', 'no response'))
+        if self.status >= 400:
+            return "unavailable: HTTP status code {}".format(self.status)
+        if self.feed_data.bozo:
+            return "malformed: {}".format(self.feed_data.get('bozo_exception', 'bozo data'))
+        return None
+
+
+# Retrieves the given feed URLs concurrently, producing a ProbeResult for each
+# URL in the same order as the URLs
+def probe_feeds(urls, *, jobs=8, timeout=30):
+    def probe(url):
+        try:
+            return ProbeResult(url, feed_data=feedparser.parse(url))
+        except Exception as e:
+            return ProbeResult(url, error=e)
+
+    # feedparser offers no timeout of its own, so we set the default timeout
+    # for all sockets opened during probing
+    old_timeout = socket.getdefaulttimeout()
+    socket.setdefaulttimeout(timeout)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            return list(pool.map(probe, urls))
+    finally:
+        socket.setdefaulttimeout(old_timeout)
+
+
+# Prints a table with the outcome of each probe
+def print_probe_summary(probes, file=sys.stderr):
+    if not probes:
+        return
+    for probe in probes:
+        status = probe.status if probe.status is not None else '-'
+        if probe.problem:
+            outcome = probe.problem
+        elif probe.redirected:
+            outcome = "redirected to '{}'".format(probe.resolved_url)
+        else:
+            outcome = 'ok'
+        print("{:>4}  {}  {}".format(status, probe.url, outcome), file=file)
+    failed = sum(1 for probe in probes if probe.problem)
+    print("{} of {} feeds retrieved, {} failed".format(len(probes) - failed, len(probes), failed), file=file)
+
+
+# Stores the items of already retrieved feeds in the configuration's
+# database, without running any hooks. Takes a dictionary from feed key to
+# retrieved feed data.
+def seed_database(config, seed_data):
+    conn = config.open_database()
+    for key, feed_data in seed_data.items():
+        feed = config.get_feed(key)
+        if not feed:
+            continue
+        with conn:
+            success, new_items = update_feed(feed, conn, force_update=True, collapse_duplicates=config.collapse_duplicates, feed_data=feed_data)
+        if success:
+            log_message("Seeded feed '{}' with {} items".format(key, len(new_items)))
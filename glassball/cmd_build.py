@@ -1,8 +1,18 @@
+import collections
 import datetime
+import functools
+import gzip
+import json
 
 import jinja2
 
-from .common import copy_resources, Configuration, GlassballError, db_datetime, log_error, log_message
+# Brotli support is optional: without it only gzip siblings are produced
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .common import copy_resources, Configuration, GlassballError, CommandError, parse_update_interval, db_datetime, db_content, profile_phase, log_error, log_message
 
 
 class BuildError(GlassballError):
@@ -11,16 +21,201 @@ class BuildError(GlassballError):
 
 def register_command(commands, common_args):
     args = commands.add_parser('build', help='Builds a set of static HTML files that can be used to view the feed items', parents=[common_args])
+    args.add_argument('feeds', nargs='*', default=[], help='A list of feeds whose item files to render, by default the item files of all feeds are rendered')
+    args.add_argument('-s', '--since', default=None, help="Only render item files for items published within the given interval, e.g. '2 hours'")
     args.add_argument('-f', '--force', action='store_true', help='Force update of existing item files by overwriting them')
+    args.add_argument('-z', '--precompress', action='store_true', help='Produce precompressed .gz (and .br, if brotli is installed) siblings for built files')
     args.set_defaults(command_func=command_build)
 
 
 def command_build(options):
     config = Configuration(options.config)
-    build_site(config, overwrite=options.force)
 
+    # Convert any given feed keys to actual feed references
+    feeds = None
+    if options.feeds:
+        feeds = []
+        for key in options.feeds:
+            feed = config.get_feed(key)
+            if not feed:
+                raise CommandError("'{}' is not a configured feed".format(key))
+            feeds.append(feed)
+
+    # Determine the start of the time window to render
+    since = None
+    if options.since:
+        try:
+            since = datetime.datetime.utcnow() - parse_update_interval(options.since)
+        except ValueError as e:
+            raise CommandError("Cannot understand interval '{}': {}".format(options.since, e)) from e
+
+    build_site(config, overwrite=options.force, precompress=options.precompress, feeds=feeds, since=since)
+
+
+# File types for which precompressed siblings are produced
+PRECOMPRESS_SUFFIXES = {'.html', '.css', '.js', '.json', '.atom'}
+
+
+# Writes compressed siblings of the given file, skipping siblings that are
+# already up to date with the file itself
+def precompress_file(path):
+    compressors = [('.gz', lambda data: gzip.compress(data, compresslevel=9))]
+    if brotli:
+        compressors.append(('.br', lambda data: brotli.compress(data)))
+
+    source_mtime = path.stat().st_mtime
+    data = None
+    for suffix, compress in compressors:
+        target = path.with_name(path.name + suffix)
+        if target.exists() and target.stat().st_mtime >= source_mtime:
+            continue
+        if data is None:
+            data = path.read_bytes()
+        target.write_bytes(compress(data))
+
+
+# Produces compressed siblings for all relevant files in the build path
+def precompress_site(config):
+    if not brotli:
+        log_message("Brotli is not available, only producing gzip files...")
+    for path in config.build_path.glob('**/*'):
+        if path.suffix in PRECOMPRESS_SUFFIXES and path.is_file():
+            precompress_file(path)
+
+
+# Removes compressed siblings that are older than their file, as left behind
+# by an earlier build with precompression, so they are not served instead of
+# the file
+def remove_stale_siblings(config):
+    for path in config.build_path.glob('**/*'):
+        if path.suffix not in ('.gz', '.br') or not path.is_file():
+            continue
+        source = path.with_suffix('')
+        if source.suffix in PRECOMPRESS_SUFFIXES and (not source.exists() or source.stat().st_mtime > path.stat().st_mtime):
+            path.unlink()
+
+
+# In-memory representation of an item, as produced by the item row factory
+# from a row selected with ITEM_COLUMNS, optionally followed by the content
+# column. Content is decompressed on access, so items that are not rendered in
+# full do not pay for it.
+class Item(collections.namedtuple('Item', ['id', 'feed', 'feeds', 'guid', 'published', 'link', 'title', 'author', 'raw_content'])):
+    __slots__ = ()
+
+    @property
+    def content(self):
+        return db_content(self.raw_content)
+
+
+# The item columns selected for the item row factory, in the order of Item's
+# fields. The `feeds` column lists the keys of all feeds the item belongs to.
+# The content is left out, so scans over all items stay small.
+ITEM_COLUMNS = '''
+    id, feed,
+    feed || coalesce(' ' || (SELECT group_concat(feed, ' ') FROM item_feed WHERE item = item.id), '') AS feeds,
+    guid, published, link, title, author'''
+
+
+# Produces a row factory that converts rows selected with ITEM_COLUMNS to Item
+# records, with memoized feed lookups
+def item_row_factory(config):
+    @functools.lru_cache(maxsize=None)
+    def get_feeds(keys):
+        return tuple(feed for feed in map(config.get_feed, keys.split()) if feed)
+
+    def factory(cursor, row):
+        id, feed, feeds, guid, published, link, title, author = row[:8]
+        return Item(id, config.get_feed(feed), get_feeds(feeds), guid, db_datetime(published), link, title, author, row[8] if len(row) > 8 else None)
+    return factory
+
+
+# Item selection for exported feeds, the placeholder is replaced by the
+# condition that selects the exported feed's items
+EXPORT_QUERY = 'SELECT ' + ITEM_COLUMNS + ''', content FROM item {} ORDER BY published DESC LIMIT ?'''
+
+
+# Writes the combined and per-feed exports of the most recent items. Exports
+# are only rewritten if the items or settings of their feeds changed since the
+# previous build.
+def export_feeds(config, conn, env, item_factory, database_id):
+    export_path = config.build_path / 'export'
+    if not (export_path / 'feeds').exists():
+        (export_path / 'feeds').mkdir(parents=True)
+    atom_template = env.get_template('export-atom.xml')
+    limit = config.export_items
 
-def build_site(config, *, overwrite=False):
+    # Determine the state of each feed, to compare against the state of the
+    # previous export
+    c = conn.cursor()
+    c.execute('SELECT feed, item_count, newest_published, last_new_item FROM feed_stats')
+    stats = {row['feed']: list(row) for row in c.fetchall()}
+    c.execute('SELECT feed, count(*) FROM item_feed GROUP BY feed')
+    memberships = dict(c.fetchall())
+    state = {feed.key: [feed.title, feed.url, limit, stats.get(feed.key), memberships.get(feed.key, 0)] for feed in config.feeds}
+
+    # The state is kept next to the database rather than in the published
+    # build, earlier builds kept it in the export directory
+    state_file = config.database_file.with_name(config.database_file.name + '.export-state.json')
+    previous = json.loads(state_file.read_text(encoding='utf-8')) if state_file.exists() else {}
+    for old_state_file in [export_path / 'state.json', export_path / 'state.json.gz', export_path / 'state.json.br']:
+        if old_state_file.exists():
+            old_state_file.unlink()
+
+    items = conn.cursor()
+    items.row_factory = item_factory
+
+    # Writes the Atom and JSON feed exports for the given items
+    def write_exports(base_path, key, title, items):
+        updated = max((item.published for item in items), default=datetime.datetime.utcnow())
+        with profile_phase('render'):
+            with open(str(base_path.with_suffix('.atom')), 'w', encoding='utf-8') as f:
+                atom_template.stream(database_id=database_id, key=key, title=title, updated=updated, items=items).dump(f)
+            with open(str(base_path.with_suffix('.json')), 'w', encoding='utf-8') as f:
+                json.dump(json_feed(title, items), f)
+
+    # Per-feed exports
+    for feed in config.feeds:
+        base_path = export_path / 'feeds' / feed.key
+        if previous.get(feed.key) == state[feed.key] and base_path.with_suffix('.atom').exists():
+            continue
+        items.execute(EXPORT_QUERY.format('WHERE feed = ? OR id IN (SELECT item FROM item_feed WHERE feed = ?)'), (feed.key, feed.key, limit))
+        write_exports(base_path, feed.key, feed.title, items.fetchall())
+
+    # Combined export
+    if previous != state or not (export_path / 'all.atom').exists():
+        items.execute(EXPORT_QUERY.format(''), (limit,))
+        write_exports(export_path / 'all', 'all', 'Glassball', items.fetchall())
+
+    state_file.write_text(json.dumps(state), encoding='utf-8')
+
+
+# Produces a JSON Feed document for the given items
+def json_feed(title, items):
+    def json_item(item):
+        result = {
+            'id': item.guid,
+            'title': item.title,
+            'date_published': item.published.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+        if item.link:
+            result['url'] = item.link
+        if item.author:
+            result['authors'] = [{'name': item.author}]
+        content = item.content
+        if content:
+            result['content_html'] = content
+        return result
+    return {
+        'version': 'https://jsonfeed.org/version/1.1',
+        'title': title,
+        'items': [json_item(item) for item in items],
+    }
+
+
+# Builds the static viewer. The index is always rendered in full, item files
+# can be limited to the items of the given feeds, and to items published after
+# the given moment (in UTC).
+def build_site(config, *, overwrite=False, precompress=False, feeds=None, since=None):
     # Set up jinja2 environment
     env = jinja2.Environment(loader=jinja2.PackageLoader(__name__, 'templates'), autoescape=jinja2.select_autoescape(['html', 'xml']))
 
@@ -33,22 +228,15 @@ def build_site(config, *, overwrite=False):
         return value.strftime('%H:%M') if delta.days == 0 else value.strftime('%Y-%m-%d')
     env.filters['ago'] = format_ago
 
-    # Feed item field converters to go from database to in-memory
-    item_fields = {
-        'id': lambda x: x,
-        'feed': lambda x: config.get_feed(x),
-        'guid': lambda x: x,
-        'published': db_datetime,
-        'link': lambda x: x,
-        'title': lambda x: x,
-        'author': lambda x: x,
-        'content': lambda x: x,
-    }
+    # Row factory to go from database to in-memory items
+    item_factory = item_row_factory(config)
 
-    # Transformation function to apply item field converters
-    def item_transform(row):
-        available = row.keys()
-        return {k: f(row[k]) for k,f in item_fields.items() if k in available}
+    # Styling injected into the item pages of feeds, read once per feed
+    @functools.lru_cache(maxsize=None)
+    def injected_styling(feed):
+        if feed and feed.inject_style_file:
+            return config.relative_path(feed.inject_style_file).read_text(encoding='utf-8')
+        return None
 
     # Ensure availability of build path
     if not config.build_path.exists():
@@ -65,11 +253,6 @@ def build_site(config, *, overwrite=False):
     copy_resources('static', config.build_path / 'static')
 
     with config.open_database() as conn:
-        # 1: Render out the index file
-        index_template = env.get_template('index.html')
-        items = conn.cursor()
-        items.execute('SELECT id, feed, title, author, published FROM item ORDER BY published DESC')
-
         c = conn.cursor()
         c.execute('SELECT id from database_id')
         database_id = c.fetchone()['id']
@@ -77,28 +260,67 @@ def build_site(config, *, overwrite=False):
         c.execute('SELECT feed, updated, success FROM last_update')
         last_update = {config.get_feed(feed): {'updated': db_datetime(updated), 'success': success} for feed, updated, success in c.fetchall()}
 
-        with open(str(config.build_path / 'index.html'), 'w', encoding='utf-8') as f:
-            f.write(index_template.render(database_id=database_id, feeds=config.feeds, last_update=last_update, items=map(item_transform, items)))
+        c.execute('SELECT feed, item_count, newest_published FROM feed_stats')
+        feed_stats = {config.get_feed(feed): {'item_count': item_count, 'newest_published': db_datetime(newest) if newest else None} for feed, item_count, newest in c.fetchall()}
 
-        # 2: Ensure availability of `items` directory under build path
+        # 1: Ensure availability of `items` directory under build path
         item_path = config.build_path / 'items'
         if not item_path.exists():
             item_path.mkdir()
 
-        # 3: Render out an item file for each item
+        # 2: Render out an item file for each item, this is done while the
+        # index is rendered, so both share a single pass over the items
         item_template = env.get_template('item.html')
+
+        # Determines whether the item is part of the requested items
+        def selected(item):
+            if feeds is not None and not any(feed in feeds for feed in item.feeds):
+                return False
+            if since is not None and item.published < since:
+                return False
+            return True
+
+        # Retrieves the enclosures of an item, linking to the local copy in the
+        # media cache if there is one and the media cache is served
+        media_url = config.media_url
+        def item_enclosures(item):
+            enclosures = []
+            for url, type, length, cached in conn.execute('SELECT url, type, length, cached FROM enclosure WHERE item = ? ORDER BY id', (item.id,)):
+                name = url.rsplit('/', 1)[-1] or url
+                if cached and media_url:
+                    url = media_url.rstrip('/') + '/' + cached
+                enclosures.append({'url': url, 'name': name, 'type': type, 'length': length})
+            return enclosures
+
+        def render_item_files(items):
+            for item in items:
+                # Determine item file and only render it if we need to
+                item_file = item_path / "{}.html".format(item.id)
+                if selected(item) and (overwrite or not item_file.exists()):
+                    # Only load the content of the items that are rendered
+                    content = conn.execute('SELECT content FROM item WHERE id = ?', (item.id,)).fetchone()[0]
+                    item = item._replace(raw_content=content)
+                    enclosures = item_enclosures(item)
+                    with open(str(item_file), 'w', encoding='utf-8') as f, profile_phase('render'):
+                        item_template.stream(feed=item.feed, item=item, enclosures=enclosures, injected_styling=injected_styling(item.feed)).dump(f)
+                yield item
+
+        # 3: Render out the index file, streaming the rendered index straight
+        # into the file, so the complete page is never held in memory
+        index_template = env.get_template('index.html')
         items = conn.cursor()
-        items.execute('SELECT id, link, feed, title, author, published, content FROM item')
-        for item in items:
-            item = item_transform(item)
-            feed = item['feed']
-            # Determine item file and skip out if we do not need to render it
-            item_file = item_path / "{}.html".format(item['id'])
-            if item_file.exists() and not overwrite:
-                continue
-            # Prepare for rendering
-            injected_styling = None
-            if feed and feed.inject_style_file:
-                injected_styling = config.relative_path(feed.inject_style_file).read_text(encoding='utf-8')
-            # Render the actual item
-            item_file.write_text(item_template.render(feed=feed, item=item, injected_styling=injected_styling), encoding='utf-8')
+        items.row_factory = item_factory
+        items.execute('SELECT ' + ITEM_COLUMNS + ' FROM item ORDER BY published DESC')
+        with open(str(config.build_path / 'index.html'), 'w', encoding='utf-8') as f, profile_phase('render'):
+            index_template.stream(database_id=database_id, feeds=config.feeds, last_update=last_update, feed_stats=feed_stats, items=render_item_files(items)).dump(f)
+
+        # 4: Export recent items as Atom and JSON feeds
+        if config.export_items:
+            export_feeds(config, conn, env, item_factory, database_id)
+
+    # Produce precompressed siblings for static file serving, or make sure no
+    # outdated ones are left
+    if precompress:
+        precompress_site(config)
+    else:
+        remove_stale_siblings(config)
@@ -1,20 +1,25 @@
 import pathlib
-import uuid
 
 import jinja2
 
-from .common import get_resource_string, open_database, Configuration, log_error, log_message
-from .cmd_opmlimport import read_opml
+from .common import create_database, Configuration, log_error, log_message
+from .cmd_opmlimport import read_opml, probe_opml_feeds
+from .cmd_add import seed_database
 
 
 def register_command(commands, common_args):
     args = commands.add_parser('init', help='Intialize a glassball configuration and database', parents=[common_args])
     args.add_argument('--import', dest='import_opml', default=None, help='An optional OPML-file to import into the created configuration')
+    args.add_argument('-p', '--probe', action='store_true', help='Retrieve each imported feed, and skip feeds that cannot be retrieved')
+    args.add_argument('-j', '--jobs', type=int, default=8, help='The number of feeds to retrieve concurrently')
+    args.add_argument('--timeout', type=float, default=30, help='The number of seconds to wait for a feed to respond')
+    args.add_argument('--seed', action='store_true', help='Store the items of the imported feeds in the created database')
     args.set_defaults(command_func=command_init)
 
 
 def command_init(options):
     ini_file = pathlib.Path(options.config)
+    seed_data = {}
 
     # Set up configuration file if necessary
     if not ini_file.exists():
@@ -31,6 +36,8 @@ def command_init(options):
             if options.import_opml:
                 import_file = options.import_opml
                 import_feeds = read_opml(options.import_opml)
+                if options.probe or options.seed:
+                    import_feeds, seed_data = probe_opml_feeds(import_feeds, jobs=options.jobs, timeout=options.timeout)
             # Render out configuration template
             config_template = env.get_template('configuration.ini')
             config.write(config_template.render(database_file=str(expected_db_path), build_path=str(expected_build_path), import_file=import_file, import_feeds=import_feeds))
@@ -43,9 +50,10 @@ def command_init(options):
     # Set up database file if necessary
     if not config.database_file.exists():
         log_message("Creating feed item database '{}'...".format(config.database_file))
-        with open_database(config.database_file) as conn:
-            schema_source = get_resource_string('schema.sql')
-            conn.executescript(schema_source)
-            conn.execute("INSERT INTO database_id VALUES(?)", (str(uuid.uuid4()),))
+        create_database(config.database_file)
     else:
         log_message("Using existing feed item database '{}'...".format(config.database_file))
+
+    # Store the items of imported feeds if requested
+    if seed_data:
+        seed_database(config, seed_data)
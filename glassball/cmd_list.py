@@ -1,6 +1,10 @@
 from .common import Configuration, db_datetime, log_error, log_message
 
 
+# Number of rows to retrieve from the database at a time
+FETCH_BATCH_SIZE = 256
+
+
 def register_command(commands, common_args):
     args = commands.add_parser('list', help='Lists feed information and feed items', parents=[common_args])
     args.add_argument('-a', '--articles', action='store_true', help='Lists articles as well')
@@ -12,15 +16,27 @@ def command_list(options):
 
     with config.open_database() as conn:
         c = conn.cursor()
+
+        # Retrieve the summaries of all feeds at once
+        c.execute("SELECT feed, updated FROM last_update")
+        last_updates = {row['feed']: db_datetime(row['updated']) for row in c.fetchall()}
+        c.execute("SELECT feed, item_count, newest_published FROM feed_stats")
+        feed_stats = {row['feed']: row for row in c.fetchall()}
+
         for feed in config.feeds:
-            c.execute("SELECT updated FROM last_update WHERE feed = ?", (feed.key,))
-            row = c.fetchone()
-            last_update = db_datetime(row['updated']) if row else None
+            last_update = last_updates.get(feed.key)
+            stats = feed_stats.get(feed.key)
+            item_count = stats['item_count'] if stats else 0
+            newest = db_datetime(stats['newest_published']) if stats and stats['newest_published'] else None
 
-            print("[{}] {} <{}>  (last update {})".format(feed.key, feed.title, feed.url, last_update or 'unknown'))
+            print("[{}] {} <{}>  (last update {}, {} items, newest {})".format(feed.key, feed.title, feed.url, last_update or 'unknown', item_count, newest or 'unknown'))
 
             if options.articles:
                 c.execute("SELECT title, author, published, link FROM item WHERE feed = ? ORDER BY published DESC", (feed.key,))
-                feed_items = c.fetchall()
-                for item in feed_items:
-                    print("  {title} <{link}>\n    by {author}, at {published}".format(**item))
+                # Fetch items in batches to keep memory use flat for feeds
+                # with many items
+                feed_items = c.fetchmany(FETCH_BATCH_SIZE)
+                while feed_items:
+                    for item in feed_items:
+                        print("  {title} <{link}>\n    by {author}, at {published}".format(**item))
+                    feed_items = c.fetchmany(FETCH_BATCH_SIZE)
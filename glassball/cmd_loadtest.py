@@ -0,0 +1,325 @@
+import configparser
+import datetime
+import http.server
+import pathlib
+import random
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from xml.sax.saxutils import escape
+
+# Peak memory usage is only available on platforms with the resource module
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .common import create_database, open_database, CommandError, log_error, log_message
+
+
+def register_command(commands, common_args):
+    args = commands.add_parser('loadtest', help='Runs updates of many generated feeds against a local mock server and reports their performance', parents=[common_args])
+    args.add_argument('-n', '--feeds', type=int, default=1000, help='The number of feeds to generate')
+    args.add_argument('--items', type=int, default=20, help='The number of items in each feed')
+    args.add_argument('-r', '--rounds', type=int, default=2, help='The number of update rounds to run, every feed publishes a new item between rounds')
+    for kind, default, description in FEED_KINDS:
+        args.add_argument('--' + kind, type=float, default=default, metavar='FRACTION', help='The fraction of feeds that {} (default: {})'.format(description, default))
+    args.add_argument('--delay', type=float, default=1, help='The number of seconds slow feeds take to respond')
+    args.add_argument('--huge-items', type=int, default=2000, help='The number of items in each huge feed')
+    args.add_argument('--random-seed', type=int, default=0, help='The seed for assigning behaviours to feeds')
+    args.add_argument('-d', '--directory', default=None, help='The directory for the generated configuration, database and update log, by default a temporary directory that is removed afterwards')
+    args.set_defaults(command_func=command_loadtest)
+
+
+# The feed behaviours that can be mixed in, with their default fraction of the
+# feeds. The remaining feeds behave normally.
+FEED_KINDS = [
+    ('slow', 0.02, 'respond slowly'),
+    ('failing', 0.05, 'fail with server errors, missing feeds or dropped connections'),
+    ('redirecting', 0.05, 'redirect to another URL'),
+    ('not-modified', 0.2, 'reply with 304 Not Modified after their first retrieval'),
+    ('huge', 0.01, 'contain a huge number of items'),
+]
+
+
+def command_loadtest(options):
+    fractions = [(kind, getattr(options, kind.replace('-', '_'))) for kind, _, _ in FEED_KINDS]
+    if any(fraction < 0 for _, fraction in fractions) or sum(fraction for _, fraction in fractions) > 1:
+        raise CommandError("Cannot mix in feed behaviours: fractions must be positive and add up to at most 1")
+    if options.feeds < 1 or options.rounds < 1:
+        raise CommandError("Cannot load test without feeds or rounds")
+
+    # Assign a behaviour to each feed
+    kinds = []
+    for kind, fraction in fractions:
+        kinds.extend([kind] * round(fraction * options.feeds))
+    kinds = (kinds + ['normal'] * options.feeds)[:options.feeds]
+    random.Random(options.random_seed).shuffle(kinds)
+    feed_kinds = {'load-{:05}'.format(i): kind for i, kind in enumerate(kinds)}
+
+    if options.directory:
+        directory = pathlib.Path(options.directory)
+        if (directory / 'loadtest.db').exists():
+            raise CommandError("Cannot load test in '{}': it already contains a load test database".format(directory))
+        if not directory.exists():
+            directory.mkdir(parents=True)
+    else:
+        directory = pathlib.Path(tempfile.mkdtemp(prefix='glassball-loadtest-'))
+
+    server = MockFeedServer(feed_kinds, items=options.items, huge_items=options.huge_items, delay=options.delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        config_file = write_configuration(directory, server, feed_kinds)
+        database_file = directory / 'loadtest.db'
+        create_database(database_file)
+        log_message("Load testing {} feeds in '{}' ({})...".format(len(feed_kinds), directory, ', '.join('{} {}'.format(kinds.count(kind), kind) for kind in sorted(set(kinds)))))
+
+        database_size = database_file.stat().st_size
+        item_count = 0
+        updated = {}
+        for number in range(1, options.rounds + 1):
+            # Update times are stored with a resolution of seconds, rounds
+            # must not share one to tell which feeds were updated
+            if number > 1:
+                time.sleep(1)
+
+            # Run the update command as a cronjob would, so its memory usage is
+            # measured separately from the mock server's
+            start = time.monotonic()
+            result = subprocess.run([sys.executable, '-m', __package__, 'update', '--force', '--quiet', '--config', str(config_file), '--log', str(directory / 'update.log')])
+            duration = time.monotonic() - start
+            if result.returncode != 0:
+                log_error("Update of round {} exited with status {}".format(number, result.returncode))
+
+            with open_database(database_file) as conn:
+                stats = round_stats(conn, feed_kinds, updated)
+            updated = stats['updated']
+            new_items = stats['item_count'] - item_count
+            item_count = stats['item_count']
+            growth = database_file.stat().st_size - database_size
+            database_size += growth
+            server.next_round()
+
+            print("Round {}: {} of {} feeds in {:.1f} s ({:.1f} feeds/s), {} new items ({:.1f} items/s), {} failed".format(
+                number, len(stats['latencies']), len(feed_kinds), duration, len(stats['latencies']) / duration, new_items, new_items / duration, stats['failed']))
+            print("  update latency: {}".format(format_percentiles(stats['latencies'])))
+            print("  database size: {} ({:+.1f} MB)".format(format_megabytes(database_size), growth / 2**20))
+
+        # Break down the last round by feed behaviour
+        print("Update latency by feed behaviour in the last round:")
+        for kind, (latencies, failed) in sorted(stats['by_kind'].items()):
+            print("  {:<12} {:>6} feeds, {:>6} failed, {}".format(kind, len(latencies), failed, format_percentiles(latencies)))
+
+        if resource:
+            print("Peak RSS of update: {}".format(format_megabytes(peak_child_rss())))
+    finally:
+        server.shutdown()
+        server.server_close()
+        if not options.directory:
+            shutil.rmtree(str(directory))
+
+
+# Writes a configuration with a section for each feed served by the server,
+# returns the configuration file
+def write_configuration(directory, server, feed_kinds):
+    config = configparser.ConfigParser(interpolation=None)
+    config['global'] = {
+        'database': 'loadtest.db',
+        'build path': 'build',
+    }
+    for key, kind in feed_kinds.items():
+        config['feed:' + key] = {
+            'url': server.feed_url(key),
+            'title': 'Load test {} ({})'.format(key, kind),
+        }
+    config_file = directory / 'feeds.ini'
+    with open(str(config_file), 'w', encoding='utf-8') as f:
+        config.write(f)
+    return config_file
+
+
+# Collects the outcome of an update round from the database: the update
+# latencies and failures overall and per feed behaviour, and the item count.
+# Only feeds with a different update time than in the previous round (as
+# returned in `updated`) were updated in this round.
+def round_stats(conn, feed_kinds, previous_updated):
+    c = conn.cursor()
+    c.execute('SELECT feed, updated, success FROM last_update')
+    updated = {}
+    success = {}
+    for feed, moment, succeeded in c.fetchall():
+        updated[feed] = moment
+        success[feed] = succeeded
+    c.execute('SELECT feed, last_fetch_duration FROM feed_stats')
+    durations = dict(c.fetchall())
+    c.execute('SELECT count(*) FROM item')
+    item_count = c.fetchone()[0]
+
+    latencies = []
+    by_kind = {}
+    for key, kind in feed_kinds.items():
+        kind_latencies, failed = by_kind.get(kind, ([], 0))
+        if key in updated and updated[key] != previous_updated.get(key):
+            latencies.append(durations.get(key) or 0)
+            kind_latencies.append(durations.get(key) or 0)
+            if not success[key]:
+                failed += 1
+        by_kind[kind] = (kind_latencies, failed)
+
+    return {
+        'latencies': latencies,
+        'failed': sum(failed for _, failed in by_kind.values()),
+        'by_kind': by_kind,
+        'item_count': item_count,
+        'updated': updated,
+    }
+
+
+# Formats the median, 90th and 99th percentile and maximum of the durations,
+# using nearest-rank percentiles
+def format_percentiles(durations):
+    if not durations:
+        return 'no measurements'
+    durations = sorted(durations)
+    def percentile(p):
+        return durations[max(0, -(-len(durations) * p // 100) - 1)]
+    return 'p50 {:.3f} s, p90 {:.3f} s, p99 {:.3f} s, max {:.3f} s'.format(percentile(50), percentile(90), percentile(99), durations[-1])
+
+
+def format_megabytes(size):
+    return '{:.1f} MB'.format(size / 2**20)
+
+
+# Returns the peak resident set size of all finished child processes in bytes
+def peak_child_rss():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+#
+# Mock feed server
+#
+
+class MockFeedServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, feed_kinds, *, items, huge_items, delay):
+        super().__init__(('127.0.0.1', 0), MockFeedHandler)
+        self.feed_kinds = feed_kinds
+        self.items = items
+        self.huge_items = huge_items
+        self.delay = delay
+        self.round = 0
+        self.started = datetime.datetime.utcnow().replace(microsecond=0)
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def feed_url(self, key):
+        return 'http://127.0.0.1:{}/feeds/{}'.format(self.server_address[1], key)
+
+    # Moves on to the next round, in which every feed has published a new item
+    def next_round(self):
+        self.round += 1
+
+    # Counts a request for the feed, returns the number of earlier requests
+    def count_request(self, key):
+        with self._lock:
+            count = self._requests.get(key, 0)
+            self._requests[key] = count + 1
+            return count
+
+    # Produces the Atom document of the feed in the current round. Every round
+    # adds a new item, and older items drop out of the feed.
+    def feed_document(self, key, item_count):
+        updated = self.started + datetime.timedelta(minutes=self.round)
+        entries = []
+        for serial in range(self.round + item_count - 1, self.round - 1, -1):
+            published = self.started - datetime.timedelta(minutes=item_count - 1 - serial)
+            entries.append(MOCK_ENTRY.format(
+                id='urn:glassball-loadtest:{}:{}'.format(key, serial),
+                link=escape(self.feed_url(key)) + '/items/{}'.format(serial),
+                title='Item {} of {}'.format(serial, key),
+                published=published.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                content=escape(MOCK_CONTENT)))
+        return MOCK_FEED.format(
+            id='urn:glassball-loadtest:{}'.format(key),
+            title='Load test {}'.format(key),
+            updated=updated.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            entries=''.join(entries)).encode('utf-8')
+
+
+class MockFeedHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.split('/')
+        key = parts[2] if len(parts) >= 3 and parts[1] == 'feeds' else None
+        kind = server.feed_kinds.get(key)
+        if kind is None:
+            self.send_error(404)
+            return
+        requests = server.count_request(key)
+
+        if kind == 'slow':
+            time.sleep(server.delay)
+        elif kind == 'failing':
+            # Cycle through the ways in which feeds fail
+            failure = requests % 3
+            if failure == 0:
+                self.send_error(503)
+            elif failure == 1:
+                self.send_error(404)
+            else:
+                self.close_connection = True
+            return
+        elif kind == 'redirecting' and parts[3:] != ['moved']:
+            self.send_response(301)
+            self.send_header('Location', server.feed_url(key) + '/moved')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        elif kind == 'not-modified' and requests > 0:
+            self.send_response(304)
+            self.send_header('ETag', '"{}"'.format(key))
+            self.end_headers()
+            return
+
+        body = server.feed_document(key, server.huge_items if kind == 'huge' else server.items)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/atom+xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"{}"'.format(key))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are not logged, the update log records the problems
+    def log_message(self, format, *args):
+        pass
+
+
+MOCK_FEED = '''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <id>{id}</id>
+  <title>{title}</title>
+  <updated>{updated}</updated>
+  <author><name>Glassball load test</name></author>{entries}
+</feed>
+'''
+
+MOCK_ENTRY = '''
+  <entry>
+    <id>{id}</id>
+    <link href="{link}"/>
+    <title>{title}</title>
+    <published>{published}</published>
+    <updated>{published}</updated>
+    <content type="html">{content}</content>
+  </entry>'''
+
+MOCK_CONTENT = '<p>{}</p>'.format(' '.join(['Lorem ipsum dolor sit amet, consectetur adipiscing elit.'] * 8)) * 4
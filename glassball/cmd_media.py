@@ -0,0 +1,181 @@
+import concurrent.futures
+import hashlib
+import http.client
+import os.path
+import re
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import feedparser
+
+from .common import Configuration, GlassballError, log_error, log_message
+
+
+def register_command(commands, common_args):
+    args = commands.add_parser('media', help='Downloads item enclosures into the media cache of the static viewer', parents=[common_args])
+    args.add_argument('-t', '--type', dest='types', action='append', default=[], help='Only download enclosures with a media type starting with the given prefix (e.g. audio/), can be given multiple times')
+    args.add_argument('-n', '--limit', type=int, default=None, help='The maximum number of enclosures to download')
+    args.add_argument('-j', '--jobs', type=int, default=4, help='The number of enclosures to download concurrently')
+    args.add_argument('--timeout', type=float, default=60, help='The number of seconds to wait for a download to respond')
+    args.set_defaults(command_func=command_media)
+
+
+def command_media(options):
+    config = Configuration(options.config)
+    conn = config.open_database()
+
+    if not config.media_path.exists():
+        log_message("Creating media cache directory '{}'...".format(config.media_path))
+        config.media_path.mkdir(parents=True)
+
+    # Go over the enclosures from the most recent items to the oldest, keeping
+    # the cached files and selecting the downloads that fit within the cache
+    # size. Cached files that no longer fit are evicted.
+    c = conn.cursor()
+    c.execute("SELECT e.url, e.type, max(e.length) AS length, max(e.cached) AS cached FROM enclosure e JOIN item i ON i.id = e.item GROUP BY e.url ORDER BY max(i.published) DESC")
+    remaining = config.media_cache_size
+    keep = set()
+    selected = []
+    for row in c.fetchall():
+        cached_file = config.media_path / row['cached'] if row['cached'] else None
+        if cached_file and cached_file.exists():
+            size = cached_file.stat().st_size
+            if size <= remaining:
+                remaining -= size
+                keep.add(cached_file.name)
+            continue
+        if options.types and not any((row['type'] or '').startswith(prefix) for prefix in options.types):
+            continue
+        if options.limit is not None and len(selected) >= options.limit:
+            continue
+        if (row['length'] or 1) > remaining:
+            continue
+        remaining -= row['length'] or 0
+        selected.append((row['url'], row['length'] or 0))
+        keep.add(media_file_name(row['url']) + '.part')
+
+    evict_media(config, conn, keep)
+
+    # Download the selected enclosures with an announced length concurrently,
+    # and record the results as they come in. Downloads larger than their
+    # announced length are charged to the space that is left.
+    budget = MediaBudget(remaining)
+    def fetch(url, length):
+        return download(config.media_path, url, options.timeout, length, budget)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, options.jobs)) as pool:
+        downloads = {pool.submit(fetch, url, length): url for url, length in selected if length}
+        for future in concurrent.futures.as_completed(downloads):
+            record_download(config, conn, downloads[future], future.result)
+
+    # Downloads without an announced length are charged to the space that is
+    # left as they go, they run one by one so the most recent ones come first
+    for url, length in selected:
+        if not length:
+            record_download(config, conn, url, lambda: fetch(url, 0))
+
+
+# Records the outcome of a download, given as a function that produces the
+# downloaded file's name
+def record_download(config, conn, url, result):
+    try:
+        file_name = result()
+    except (urllib.error.URLError, http.client.HTTPException, OSError, MediaCacheFullError) as e:
+        log_error("Cannot download '{}': {}".format(url, e), exception=e)
+        return
+    with conn:
+        conn.execute("UPDATE enclosure SET cached = ? WHERE url = ?", (file_name, url))
+        invalidate_items(config, conn, "SELECT item FROM enclosure WHERE url = ?", (url,))
+    log_message("Downloaded '{}'".format(url))
+
+
+class MediaCacheFullError(GlassballError):
+    pass
+
+
+# The space left in the media cache, shared by concurrent downloads
+class MediaBudget:
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+
+    # Takes the given number of bytes from the budget, returns whether they
+    # were available
+    def charge(self, amount):
+        with self._lock:
+            if amount > self.size:
+                return False
+            self.size -= amount
+            return True
+
+
+# Determines the media cache file name for an URL, keeping the extension so
+# web servers can determine the media type
+def media_file_name(url):
+    extension = os.path.splitext(urllib.parse.urlsplit(url).path)[1]
+    if not re.fullmatch(r'\.[A-Za-z0-9]{1,8}', extension):
+        extension = ''
+    return hashlib.sha1(url.encode('utf-8')).hexdigest() + extension.lower()
+
+
+# Downloads the URL into the media path, resuming a previous partial download
+# if there is one. Bytes beyond the given allowance are charged to the budget.
+# Returns the file name of the downloaded file.
+def download(media_path, url, timeout, allowance, budget):
+    file_name = media_file_name(url)
+    target = media_path / file_name
+    partial = media_path / (file_name + '.part')
+
+    headers = {'User-Agent': feedparser.USER_AGENT}
+    offset = partial.stat().st_size if partial.exists() else 0
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            # Only append if the server honours the requested range
+            if not (offset and response.status == 206):
+                offset = 0
+            written = offset
+            with open(str(partial), 'ab' if offset else 'wb') as f:
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    excess = min(len(chunk), written + len(chunk) - allowance)
+                    if excess > 0 and not budget.charge(excess):
+                        raise MediaCacheFullError("Download exceeds the media cache size")
+                    f.write(chunk)
+                    written += len(chunk)
+    except urllib.error.HTTPError as e:
+        # A partial download that is already complete cannot be resumed
+        if not (offset and e.code == 416):
+            raise
+    except MediaCacheFullError:
+        partial.unlink()
+        raise
+    partial.replace(target)
+    return file_name
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# Removes the item files of the selected items from the build, so the next
+# build renders them with their current enclosure links
+def invalidate_items(config, conn, query, parameters):
+    for (item,) in conn.execute(query, parameters).fetchall():
+        item_file = config.build_path / 'items' / '{}.html'.format(item)
+        if item_file.exists():
+            item_file.unlink()
+
+
+# Removes all files from the media cache except the ones to keep, such as
+# enclosures that no longer fit the cache size, and stale partial downloads
+def evict_media(config, conn, keep):
+    for f in config.media_path.iterdir():
+        if not f.is_file() or f.name in keep:
+            continue
+        f.unlink()
+        with conn:
+            invalidate_items(config, conn, "SELECT item FROM enclosure WHERE cached = ?", (f.name,))
+            conn.execute("UPDATE enclosure SET cached = NULL WHERE cached = ?", (f.name,))
+        log_message("Removed '{}' from the media cache".format(f.name))
@@ -0,0 +1,158 @@
+import calendar
+import pathlib
+
+from .common import Configuration, CommandError, HookError, open_database, upgrade_database, db_datetime, db_content, add_item_membership, profile_phase, log_error, log_message
+from .cmd_update import run_feed_hooks, run_global_hooks, hook_published
+
+
+def register_command(commands, common_args):
+    args = commands.add_parser('merge', help='Merges staging databases produced by sharded updates into the configured database', parents=[common_args])
+    args.add_argument('staging', nargs='+', help='The staging databases to merge')
+    args.add_argument('--remove', action='store_true', help='Remove each staging database after merging it')
+    args.set_defaults(command_func=command_merge)
+
+
+def command_merge(options):
+    config = Configuration(options.config)
+
+    for staging_file in options.staging:
+        if not pathlib.Path(staging_file).exists():
+            raise CommandError("Staging database '{}' does not exist".format(staging_file))
+
+    conn = config.open_database()
+
+    # Aggregates for global hooks
+    new_items_info = []
+    updated_feeds = set()
+
+    for staging_file in options.staging:
+        log_message("Merging staging database '{}'...".format(staging_file))
+        staging = open_database(staging_file)
+        upgrade_database(staging)
+
+        # Merge each staged feed in its own transaction. Unlike updates, the
+        # merged items are committed before the hooks run: a failing hook
+        # cannot roll them back, as the staging database may be removed
+        # after merging.
+        c = staging.cursor()
+        c.execute("SELECT feed FROM last_update UNION SELECT feed FROM item")
+        for row in c.fetchall():
+            feed = config.get_feed(row['feed'])
+            if not feed:
+                log_error("Skipping staged feed '{}': not a configured feed".format(row['feed']))
+                continue
+            with conn:
+                with profile_phase('db'):
+                    new_items = merge_feed(feed, conn, staging, collapse_duplicates=config.collapse_duplicates)
+            if new_items:
+                new_items_info.extend({'id': item['id'], 'link': item['link'], 'title': item['title']} for item in new_items)
+                updated_feeds.add(feed)
+            try:
+                run_feed_hooks(config, feed, new_items)
+            except HookError as e:
+                log_error(str(e), exception=e)
+
+        # Merge the additional feed memberships once all items are in place
+        with conn:
+            merge_memberships(conn, staging)
+
+        staging.close()
+        if options.remove:
+            pathlib.Path(staging_file).unlink()
+
+    # Run global on-update hook
+    run_global_hooks(config, updated_feeds, new_items_info)
+
+
+# Merges the staged items, update time and summary of the feed into the main
+# database. Items with a GUID that is already present are skipped, and
+# duplicates of items from other feeds are collapsed if requested. Returns the
+# newly merged items.
+def merge_feed(feed, conn, staging, collapse_duplicates=False):
+    c = conn.cursor()
+    new_items = []
+
+    staged = staging.cursor()
+    staged.execute("SELECT * FROM item WHERE feed = ? ORDER BY id", (feed.key,))
+    for row in staged:
+        c.execute("SELECT EXISTS (SELECT * FROM item WHERE guid = ?)", (row['guid'],))
+        if c.fetchone()[0]:
+            continue
+        if collapse_duplicates and (row['link_fingerprint'] or row['content_fingerprint']):
+            c.execute("SELECT id FROM item WHERE (link_fingerprint = :link_fingerprint OR content_fingerprint = :content_fingerprint) AND feed != :feed LIMIT 1", dict(row))
+            duplicate = c.fetchone()
+            if duplicate:
+                add_item_membership(c, duplicate['id'], feed.key)
+                continue
+        c.execute("INSERT INTO item(feed, guid, published, link, title, author, content, link_fingerprint, content_fingerprint) VALUES (:feed, :guid, :published, :link, :title, :author, :content, :link_fingerprint, :content_fingerprint)", dict(row))
+        item_id = c.lastrowid
+
+        # Carry over the item's enclosures
+        enclosures = staging.execute("SELECT url, type, length FROM enclosure WHERE item = ? ORDER BY id", (row['id'],)).fetchall()
+        for enclosure in enclosures:
+            c.execute("INSERT INTO enclosure(item, url, type, length) VALUES (?, ?, ?, ?)", (item_id, enclosure['url'], enclosure['type'], enclosure['length']))
+
+        new_items.append({
+            'id': item_id,
+            'feed': feed,
+            'guid': row['guid'],
+            'published': hook_published(calendar.timegm(db_datetime(row['published']).timetuple())),
+            'link': row['link'],
+            'title': row['title'],
+            'author': row['author'],
+            'content': db_content(row['content']),
+            'enclosures': [enclosure['url'] for enclosure in enclosures],
+        })
+
+    # Keep the most recent update time
+    staged.execute("SELECT updated, success FROM last_update WHERE feed = ?", (feed.key,))
+    update = staged.fetchone()
+    if update:
+        c.execute("""
+            INSERT OR REPLACE INTO last_update(feed, updated, success)
+            SELECT :feed, :updated, :success
+            WHERE NOT EXISTS (SELECT * FROM last_update WHERE feed = :feed AND updated >= :updated)""", {
+            'feed': feed.key,
+            'updated': update['updated'],
+            'success': update['success'],
+        })
+
+    # Update the feed's summary with the merged items
+    staged.execute("SELECT last_new_item, last_fetch_duration FROM feed_stats WHERE feed = ?", (feed.key,))
+    stats = staged.fetchone()
+    c.execute("INSERT OR IGNORE INTO feed_stats(feed) VALUES (?)", (feed.key,))
+    c.execute("""
+        UPDATE feed_stats SET
+            item_count = item_count + :count,
+            newest_published = CASE
+                WHEN :newest IS NULL THEN newest_published
+                WHEN newest_published IS NULL OR :newest > newest_published THEN :newest
+                ELSE newest_published
+            END,
+            last_new_item = CASE WHEN :count > 0 THEN coalesce(:last_new_item, last_new_item) ELSE last_new_item END,
+            last_fetch_duration = coalesce(:duration, last_fetch_duration)
+        WHERE feed = :feed""", {
+        'feed': feed.key,
+        'count': len(new_items),
+        'newest': max((item['published'] for item in new_items), default=None),
+        'last_new_item': stats['last_new_item'] if stats else None,
+        'duration': stats['last_fetch_duration'] if stats else None,
+    })
+
+    return new_items
+
+
+# Merges the additional feed memberships of staged items, and those staged for
+# items of the main database, matching items by their GUID
+def merge_memberships(conn, staging):
+    staged = staging.cursor()
+    staged.execute("SELECT m.feed, i.guid FROM item_feed m JOIN item i ON i.id = m.item")
+    memberships = staged.fetchall()
+    if staging.execute("SELECT EXISTS (SELECT * FROM sqlite_master WHERE name = 'staged_item_feed')").fetchone()[0]:
+        memberships += staged.execute("SELECT feed, guid FROM staged_item_feed").fetchall()
+    c = conn.cursor()
+    for row in memberships:
+        c.execute("SELECT id FROM item WHERE guid = ? AND feed != ?", (row['guid'], row['feed']))
+        item = c.fetchone()
+        if item:
+            add_item_membership(c, item['id'], row['feed'])
@@ -3,7 +3,8 @@ import configparser
 import sys
 import xml.etree.ElementTree
 
-from .common import Configuration, slugify, find_free_name, CommandError, log_error, log_message
+from .common import Configuration, slugify, NameAllocator, CommandError, log_error, log_message
+from .cmd_add import add_probe_arguments, probe_feeds, print_probe_summary, seed_database
 
 
 def register_command(commands, common_args):
@@ -11,6 +12,9 @@ def register_command(commands, common_args):
     args.add_argument('opml', type=argparse.FileType(), help='An OPML file to process')
     args.add_argument('-f', '--force', action='store_true', help='Output all feeds regardless of presence in current configuration')
     args.add_argument('-w', '--write-config', action='store_true', help='Writes the import feeds directly to the configuration')
+    args.add_argument('-p', '--probe', action='store_true', help='Retrieve each feed before importing it, and skip feeds that cannot be retrieved')
+    args.add_argument('--no-redirect', action='store_true', help='When probing, use the URLs verbatim, do not follow redirects to determine the actual URL to use')
+    add_probe_arguments(args)
     args.set_defaults(command_func=command_import_opml)
 
 
@@ -24,15 +28,23 @@ def command_import_opml(options):
         known_names = {feed.key for feed in config.feeds}
         known_urls = {feed.url for feed in config.feeds}
 
-    # Read the OPML file to get a list of prepared new feeds
+    if options.seed and not options.write_config:
+        raise CommandError("Cannot seed the database with imported feeds without writing them to the configuration")
+
+    # Read the OPML file to get a list of prepared new feeds, and skip the
+    # feeds for which we already know the URL
     feeds = read_opml(options.opml, known_names=known_names)
+    if not options.force:
+        feeds = {feed: settings for feed, settings in feeds.items() if settings['url'] not in known_urls}
+
+    # Retrieve the feeds to weed out the ones that cannot be used
+    seed_data = {}
+    if options.probe or options.seed:
+        feeds, seed_data = probe_opml_feeds(feeds, jobs=options.jobs, timeout=options.timeout, follow_redirects=not options.no_redirect)
 
     # Set up configuration snippet
     result = configparser.ConfigParser(interpolation=None)
     for feed, settings in feeds.items():
-        # Skip the feed if we already know the URL
-        if settings['url'] in known_urls and not options.force:
-            continue
         result[feed] = {}
         result[feed]['url'] = settings['url']
         result[feed]['title'] = settings['title']
@@ -47,27 +59,55 @@ def command_import_opml(options):
     else:
         result.write(sys.stdout)
 
+    # Store the retrieved items if requested
+    if options.seed:
+        seed_database(Configuration(options.config), seed_data)
+
+
+# Retrieves the feeds read from an OPML file, dropping the feeds that cannot be
+# used and following redirects if requested. Returns the remaining feeds and a
+# dictionary from feed key to the retrieved feed data.
+def probe_opml_feeds(feeds, *, jobs, timeout, follow_redirects=True):
+    probes = probe_feeds([settings['url'] for settings in feeds.values()], jobs=jobs, timeout=timeout)
+    print_probe_summary(probes)
+
+    result = {}
+    feed_data = {}
+    for (feed, settings), probe in zip(feeds.items(), probes):
+        if probe.problem:
+            continue
+        result[feed] = dict(settings)
+        if follow_redirects:
+            result[feed]['url'] = probe.resolved_url
+        feed_data[feed[5:]] = probe.feed_data
+    return result, feed_data
+
 
 def read_opml(opml_file, known_names=()):
-    # Set of currently used names
-    names = set(known_names)
+    # Allocator for the currently used names
+    names = NameAllocator(known_names)
 
     # Result dictionary
     result = {}
 
-    # Read the OPML file into an XML tree
-    tree = xml.etree.ElementTree.parse(opml_file)
-    # Get all the outline elements from the tree
-    for node in tree.findall('.//outline'):
+    # Read the OPML file incrementally, so large files are never held in
+    # memory as a complete XML tree
+    for event, node in xml.etree.ElementTree.iterparse(opml_file, events=('start', 'end')):
+        # Discard elements that have been fully handled
+        if event == 'end':
+            node.clear()
+            continue
+        # Skip anything that is not an outline element
+        if node.tag != 'outline':
+            continue
         # Get the outline's url or skip this node
         url = node.attrib.get('xmlUrl')
         if not url:
             continue
         # Get the outline's text or
-        text = node.attrib.get('text', 'unnamed-' + str(len(names)))
+        text = node.attrib.get('text', 'unnamed-' + str(len(names.names)))
         # Determine the new feed's name
-        name = find_free_name(slugify(text), names)
-        names.add(name)
+        name = names.allocate(slugify(text))
         key = 'feed:' + name
         # Add the feed information to the result
         result[key] = {}
@@ -1,9 +1,22 @@
+import argparse
 import calendar
 import datetime
+import gzip
+import hashlib
+import html.parser
+import http.client
+import json
+import pathlib
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
 
 import feedparser
 
-from .common import Configuration, db_datetime, GlassballError, CommandError, HookError, list_hook_var, log_error, log_message
+from .common import Configuration, open_database, create_database, upgrade_database, db_datetime, content_to_db, add_item_membership, GlassballError, CommandError, HookError, list_hook_var, profile_phase, log_error, log_message
 
 
 class UpdateError(GlassballError):
@@ -16,6 +29,9 @@ def register_command(commands, common_args):
     args = commands.add_parser('update', help='Run the update process for all configured feeds', parents=[common_args])
     args.add_argument('feeds', nargs='*', default=[], help='A list of feeds to consider, by default all configured feeds are attempted')
     args.add_argument('-f', '--force', action='store_true', help='Force updates regardless of update intervals for the feeds')
+    args.add_argument('--from-cache', action='store_true', help='Re-ingest the responses stored in the fetch cache instead of retrieving feeds (implies --force)')
+    args.add_argument('--shard', type=parse_shard, default=None, metavar='I/N', help='Only update the feeds in shard I of N')
+    args.add_argument('--staging', default=None, metavar='DATABASE', help='Store new items in the given staging database instead of the configured database, to be merged later; hooks run when merging')
     args.set_defaults(command_func=command_update)
 
 
@@ -34,12 +50,84 @@ def command_update(options):
     if not feeds:
         feeds = config.feeds
 
+    # Only keep this shard's part of the feeds
+    if options.shard:
+        feeds = shard_feeds(feeds, *options.shard)
+
+    if options.from_cache and not config.fetch_cache_path:
+        raise CommandError("Cannot update from cache: no fetch cache is configured in '{}'".format(options.config))
+
     # Update the selected feeds
-    update(config, feeds, force_update=options.force)
+    update(config, feeds, force_update=options.force or options.from_cache, from_cache=options.from_cache, staging_file=options.staging)
 
 
-def update(config, feeds, force_update=False):
-    conn = config.open_database()
+# Parses a shard specification of the form `i/n`
+def parse_shard(value):
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Cannot parse shard '{}', expected the form 'i/n'".format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("Shard '{}' does not exist, shards are numbered from 1 to n".format(value))
+    return index, count
+
+
+# Selects the feeds that belong to the given shard. Feeds are assigned to
+# shards by a hash of their key, so the assignment is the same for every
+# process and every run.
+def shard_feeds(feeds, index, count):
+    def shard_of(feed):
+        return int(hashlib.sha1(feed.key.encode('utf-8')).hexdigest(), 16) % count + 1
+    return [feed for feed in feeds if shard_of(feed) == index]
+
+
+# Opens a staging database, creating it if necessary. The main database, if
+# available, is attached read-only as `main_database`, so items that are
+# already known are not staged again. New staging databases start out with the
+# main database's update times, so the update intervals of feeds are respected.
+def open_staging_database(config, staging_file):
+    staging_file = pathlib.Path(staging_file)
+    if staging_file.exists():
+        conn = open_database(staging_file)
+        upgrade_database(conn)
+        created = False
+    else:
+        log_message("Creating staging database '{}'...".format(staging_file))
+        create_database(staging_file)
+        conn = open_database(staging_file)
+        created = True
+
+    # Memberships of items of the main database found through other feeds,
+    # these are keyed by GUID as the items are not in the staging database
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS staged_item_feed (guid TEXT NOT NULL, feed TEXT NOT NULL, PRIMARY KEY (guid, feed))")
+
+    if config.database_file.exists():
+        conn.execute("ATTACH DATABASE ? AS main_database", ('file:{}?mode=ro'.format(urllib.parse.quote(str(config.database_file.resolve()))),))
+        if created:
+            with conn:
+                conn.execute("INSERT INTO last_update SELECT * FROM main_database.last_update")
+    return conn
+
+
+def update(config, feeds, force_update=False, from_cache=False, staging_file=None):
+    # Updates to a staging database do not run hooks: the hooks run when the
+    # staged items are merged into the main database
+    main_database = None
+    if staging_file:
+        conn = open_staging_database(config, staging_file)
+        if any(row['name'] == 'main_database' for row in conn.execute('PRAGMA database_list')):
+            main_database = 'main_database'
+    else:
+        conn = config.open_database()
+
+    # Determine how feeds are retrieved: through the fetch cache if one is
+    # configured, and directly by feedparser otherwise
+    fetch = feedparser.parse
+    cache = None
+    if config.fetch_cache_path:
+        cache = FetchCache(config.fetch_cache_path, config.fetch_cache_size)
+        fetch = cache.load if from_cache else cache.fetch
 
     # Aggregates for global hooks
     new_items_info = []
@@ -48,57 +136,74 @@ def update(config, feeds, force_update=False):
     for feed in feeds:
         try:
             with conn:
-                success, new_items = update_feed(feed, conn, force_update=force_update)
-                if not success:
+                success, new_items = update_feed(feed, conn, force_update=force_update, collapse_duplicates=config.collapse_duplicates, fetch=fetch, main_database=main_database)
+                if not success or staging_file:
                     continue
 
-                # Run per-item hook
-                for item in new_items:
-                    replacements = {
-                        'id': item['id'],
-                        'feed': feed.key,
-                        'feed-title': feed.title,
-                        'published': item['published'],
-                        'link': item['link'],
-                        'title': item['title'],
-                        'author': item['author'],
-                    }
-                    environment = {
-                        'ITEM_ID': str(item['id']),
-                        'ITEM_FEED': feed.key,
-                        'ITEM_FEED_TITLE': feed.title,
-                        'ITEM_PUBLISHED': item['published'],
-                        'ITEM_LINK': item['link'],
-                        'ITEM_TITLE': item['title'],
-                        'ITEM_AUTHOR': item['author'],
-                        'ITEM_CONTENT': item['content'],
-                    }
-                    config.run_hook(feed.config_section, 'on item', replacements=replacements, environment=environment)
-                    config.run_hook('global', 'on item', replacements=replacements, environment=environment)
-
-                # Run update hook and update aggregates for global hooks
+                # Run item and update hooks and update aggregates for global
+                # hooks
+                run_feed_hooks(config, feed, new_items)
                 if new_items:
-                    # Run per-feed update hook
-                    config.run_hook(feed.config_section, 'on update', replacements={
-                        'feed': feed.key,
-                        'feed-title': feed.title,
-                        'ids': list_hook_var(item['id'] for item in new_items),
-                        'links': list_hook_var(item['link'] for item in new_items),
-                        'titles': list_hook_var(item['title'] for item in new_items),
-                    }, environment={
-                        'FEED': feed.key,
-                        'FEED_TITLE': feed.title,
-                        'ITEM_IDS': ' '.join(str(item['id']) for item in new_items)
-                    })
-
-                    # Update aggregation list new items
                     new_items_info.extend({'id': item['id'], 'link': item['link'], 'title': item['title']} for item in new_items)
                     updated_feeds.add(feed)
         except HookError as e:
             log_error(str(e), exception=e)
             continue
 
+    # Keep the fetch cache within its size, once all responses are stored
+    if cache and not from_cache:
+        cache.evict()
+
     # Run global on-update hook
+    run_global_hooks(config, updated_feeds, new_items_info)
+
+
+# Runs the per-item hooks for each new item of the feed, followed by the feed's
+# update hook if there are new items
+def run_feed_hooks(config, feed, new_items):
+    # Run per-item hook
+    for item in new_items:
+        replacements = {
+            'id': item['id'],
+            'feed': feed.key,
+            'feed-title': feed.title,
+            'published': item['published'],
+            'link': item['link'],
+            'title': item['title'],
+            'author': item['author'],
+            'enclosures': list_hook_var(item['enclosures']),
+        }
+        environment = {
+            'ITEM_ID': str(item['id']),
+            'ITEM_FEED': feed.key,
+            'ITEM_FEED_TITLE': feed.title,
+            'ITEM_PUBLISHED': item['published'],
+            'ITEM_LINK': item['link'],
+            'ITEM_TITLE': item['title'],
+            'ITEM_AUTHOR': item['author'],
+            'ITEM_CONTENT': item['content'],
+            'ITEM_ENCLOSURES': ' '.join(item['enclosures']),
+        }
+        config.run_hook(feed.config_section, 'on item', replacements=replacements, environment=environment)
+        config.run_hook('global', 'on item', replacements=replacements, environment=environment)
+
+    # Run per-feed update hook
+    if new_items:
+        config.run_hook(feed.config_section, 'on update', replacements={
+            'feed': feed.key,
+            'feed-title': feed.title,
+            'ids': list_hook_var(item['id'] for item in new_items),
+            'links': list_hook_var(item['link'] for item in new_items),
+            'titles': list_hook_var(item['title'] for item in new_items),
+        }, environment={
+            'FEED': feed.key,
+            'FEED_TITLE': feed.title,
+            'ITEM_IDS': ' '.join(str(item['id']) for item in new_items)
+        })
+
+
+# Runs the global update hook if any feeds were updated
+def run_global_hooks(config, updated_feeds, new_items_info):
     if updated_feeds:
         config.run_hook('global', 'on update', replacements={
             'feeds': list_hook_var(feed.key for feed in updated_feeds),
@@ -112,11 +217,106 @@ def update(config, feeds, force_update=False):
         })
 
 
-def update_feed(feed, conn, now=None, force_update=False):
+# Matches data URIs as they appear in attribute values and CSS
+DATA_URI_PATTERN = re.compile(r'data:[^,\s"\'()<>]*,[^\s"\'()<>]*')
+
+
+# Determines the content to store for an entry, applying the feed's content
+# preference and size limits
+def ingest_content(feed, entry):
+    # Select the entry's content, or fall back to the description
+    content = entry.get('description')
+    if feed.prefer_content and entry.get('content'):
+        # Prefer HTML content if the entry has several content variants
+        variants = entry.content
+        selected = next((v for v in variants if v.get('type') in ('text/html', 'application/xhtml+xml')), variants[0])
+        content = selected.get('value', content)
+
+    if content is None:
+        return None
+
+    # Strip data URIs that exceed the allowed size
+    if feed.max_data_uri_size is not None:
+        content = DATA_URI_PATTERN.sub(lambda m: m.group(0) if len(m.group(0)) <= feed.max_data_uri_size else '', content)
+
+    # Cap the content to the maximum size
+    if feed.max_content_size is not None:
+        content = truncate_html(content, feed.max_content_size)
+
+    return content
+
+
+# Matches a tag or entity that was cut off at the end of truncated HTML
+PARTIAL_MARKUP_PATTERN = re.compile(r'<[^>]*$|&[#\w]*$')
+
+# Elements that have no end tag
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+
+# Tracks the elements that are open at the end of an HTML fragment
+class OpenElementParser(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_elements = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in VOID_ELEMENTS:
+            self.open_elements.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.open_elements:
+            index = len(self.open_elements) - 1 - self.open_elements[::-1].index(tag)
+            del self.open_elements[index:]
+
+
+# Cuts HTML off at the given size in bytes (encoded as UTF-8), without cutting
+# through a character, tag or entity, and closes the elements left open
+def truncate_html(content, max_size):
+    encoded = content.encode('utf-8')
+    if len(encoded) <= max_size:
+        return content
+    content = PARTIAL_MARKUP_PATTERN.sub('', encoded[:max_size].decode('utf-8', 'ignore'))
+    parser = OpenElementParser()
+    parser.feed(content)
+    parser.close()
+    return content + ''.join('</{}>'.format(tag) for tag in reversed(parser.open_elements))
+
+
+# Determines a fingerprint for an item link that is insensitive to the
+# irrelevant differences between links to the same article
+def link_fingerprint(link):
+    if not link:
+        return None
+    parts = urllib.parse.urlsplit(link.strip())
+    # Normalize host and drop default ports
+    netloc = parts.netloc.lower()
+    for scheme, port in [('http', ':80'), ('https', ':443')]:
+        if parts.scheme.lower() == scheme and netloc.endswith(port):
+            netloc = netloc[:-len(port)]
+    # Drop tracking parameters and order the remaining query parameters
+    query = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if not k.startswith('utm_'))
+    normalized = urllib.parse.urlunsplit(('', netloc, parts.path.rstrip('/'), urllib.parse.urlencode(query), ''))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+# Determines a fingerprint for item title and content that is insensitive to
+# differences in whitespace
+def content_fingerprint(title, content):
+    if not content:
+        return None
+    normalized = ' '.join('{}\n{}'.format(title or '', content).split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+# Updates the feed's items in the database. When updating a staging database,
+# `main_database` names the attached main database, whose items are not staged
+# again.
+def update_feed(feed, conn, now=None, force_update=False, collapse_duplicates=False, feed_data=None, fetch=feedparser.parse, main_database=None):
     if not now:
         now = datetime.datetime.utcnow()
 
     new_items = []
+    inserted = []
     success = False
     c = conn.cursor()
 
@@ -131,8 +331,20 @@ def update_feed(feed, conn, now=None, force_update=False):
     if not needs_update:
         return True, []
 
+    fetch_start = time.monotonic()
     try:
-        feed_data = feedparser.parse(feed.url)
+        # Retrieve the feed, unless the caller already did so
+        if feed_data is None:
+            try:
+                with profile_phase('fetch'):
+                    feed_data = fetch(feed.url)
+            except FetchCacheError as e:
+                raise UpdateError(feed, str(e)) from e
+            except (urllib.error.URLError, http.client.HTTPException, OSError, ValueError) as e:
+                # feedparser lets some failures through, such as servers
+                # closing the connection without a response, truncated
+                # responses, or malformed URLs
+                raise UpdateError(feed, "Failed to retrieve feed data from '{}': {}".format(feed.url, e)) from e
 
         if 'status' in feed_data:
             # Check the status field to provide feedback when the HTTP request
@@ -155,59 +367,87 @@ def update_feed(feed, conn, now=None, force_update=False):
             raise UpdateError(feed, "Error while processing feed data from '{}': {}".format(feed.url, feed_data.bozo_exception)) from feed_data.bozo_exception
 
         # Update feed items
-        for entry in feed_data.entries:
-            # Make sure we have an actual entry identifier. If we have no such
-            # identifier we can not handle the entry.
-            if 'id' not in entry:
-                raise UpdateError(feed, "Entry is missing identifier")
-
-            # First, check if we have the `published` or `updated` key,
-            # prefering to use `published`
-            selected_time_key = None
-            for selected_time_key in ['published_parsed', 'updated_parsed']:
-                if selected_time_key in entry:
-                    break
-            else:
-                raise UpdateError(feed, "Entry is missing both 'published' and 'updated' times")
-
-            # Check the entry for existince in database
-            c.execute("SELECT EXISTS (SELECT * FROM item WHERE guid = ?)", (entry.id,))
-            result = c.fetchall()
-            entry_exists = result and result[0][0]
-            if entry_exists:
-                continue
-
-            # Build up the local data about the feed entry. This includes
-            # mandatory data such as the feed it belongs to, the entry id, and
-            # the moment of publication. Any other fields are optional.
-
-            # Determine fallback author
-            def get_author(thing, default=None):
-                if 'author_detail' in thing and 'name' in thing.author_detail:
-                    return thing.author_detail.name
-                elif 'author' in thing:
-                    return thing.author
+        with profile_phase('db'):
+            for entry in feed_data.entries:
+                # Make sure we have an actual entry identifier. If we have no such
+                # identifier we can not handle the entry.
+                if 'id' not in entry:
+                    raise UpdateError(feed, "Entry is missing identifier")
+
+                # First, check if we have the `published` or `updated` key,
+                # prefering to use `published`
+                selected_time_key = None
+                for selected_time_key in ['published_parsed', 'updated_parsed']:
+                    if selected_time_key in entry:
+                        break
                 else:
-                    return default
-
-            fallback_author = get_author(feed_data.feed)
-
-            # Build up data
-            data = {
-                'feed': feed.key,
-                'guid': entry.id,
-                'published': calendar.timegm(entry.get(selected_time_key)),
-                'link': entry.get('link'),
-                'title': entry.get('title'),
-                'author': get_author(entry, fallback_author),
-                'content': entry.get('description')
-            }
-            c.execute("INSERT INTO item(feed, guid, published, link, title, author, content) VALUES (:feed, :guid, datetime(:published, 'unixepoch'), :link, :title, :author, :content)", data)
-            if c.lastrowid:
-                data['feed'] = feed
-                data['id'] = c.lastrowid
-                data['published'] = str(datetime.datetime.fromtimestamp(data['published']))
-                new_items.append(data)
+                    raise UpdateError(feed, "Entry is missing both 'published' and 'updated' times")
+
+                # Check the entry for existince in database
+                c.execute("SELECT id, feed FROM item WHERE guid = ?", (entry.id,))
+                existing = c.fetchone()
+                if existing:
+                    # Record the membership of the existing item if the entry was
+                    # found through another feed
+                    if collapse_duplicates and existing['feed'] != feed.key:
+                        add_item_membership(c, existing['id'], feed.key)
+                    continue
+                if main_database:
+                    c.execute("SELECT feed FROM {}.item WHERE guid = ?".format(main_database), (entry.id,))
+                    existing = c.fetchone()
+                    if existing:
+                        # Stage the membership for the merge, as above
+                        if collapse_duplicates and existing['feed'] != feed.key:
+                            c.execute("INSERT OR IGNORE INTO staged_item_feed(guid, feed) VALUES (?, ?)", (entry.id, feed.key))
+                        continue
+
+                # Build up the local data about the feed entry. This includes
+                # mandatory data such as the feed it belongs to, the entry id, and
+                # the moment of publication. Any other fields are optional.
+
+                # Determine fallback author
+                def get_author(thing, default=None):
+                    if 'author_detail' in thing and 'name' in thing.author_detail:
+                        return thing.author_detail.name
+                    elif 'author' in thing:
+                        return thing.author
+                    else:
+                        return default
+
+                fallback_author = get_author(feed_data.feed)
+
+                # Build up data
+                data = {
+                    'feed': feed.key,
+                    'guid': entry.id,
+                    'published': calendar.timegm(entry.get(selected_time_key)),
+                    'link': entry.get('link'),
+                    'title': entry.get('title'),
+                    'author': get_author(entry, fallback_author),
+                    'content': ingest_content(feed, entry)
+                }
+                fingerprints = {
+                    'link_fingerprint': link_fingerprint(data['link']),
+                    'content_fingerprint': content_fingerprint(data['title'], data['content']),
+                }
+
+                # Collapse the entry into an existing item from another feed if it
+                # has the same link or content
+                if collapse_duplicates and any(fingerprints.values()):
+                    c.execute("SELECT id FROM item WHERE (link_fingerprint = :link_fingerprint OR content_fingerprint = :content_fingerprint) AND feed != :feed LIMIT 1", dict(fingerprints, feed=feed.key))
+                    duplicate = c.fetchone()
+                    if duplicate:
+                        add_item_membership(c, duplicate['id'], feed.key)
+                        continue
+
+                c.execute("INSERT INTO item(feed, guid, published, link, title, author, content, link_fingerprint, content_fingerprint) VALUES (:feed, :guid, datetime(:published, 'unixepoch'), :link, :title, :author, :content, :link_fingerprint, :content_fingerprint)", dict(data, content=content_to_db(data['content'], feed.compress_content_size), **fingerprints))
+                if c.lastrowid:
+                    inserted.append(data['published'])
+                    data['feed'] = feed
+                    data['id'] = c.lastrowid
+                    data['published'] = hook_published(data['published'])
+                    data['enclosures'] = store_enclosures(c, data['id'], entry)
+                    new_items.append(data)
 
         # We were succesful in retrieving and updating the feed
         success = True
@@ -224,4 +464,204 @@ def update_feed(feed, conn, now=None, force_update=False):
         'success': success
     })
 
+    # Keep the feed's summary up to date with the inserted items
+    update_feed_stats(c, feed, now, inserted, time.monotonic() - fetch_start)
+
     return success, new_items
+
+
+# Formats the publication time of a new item (a UNIX timestamp) as passed to
+# hooks, in local time
+def hook_published(timestamp):
+    return str(datetime.datetime.fromtimestamp(timestamp))
+
+
+# Stores the enclosures of the entry for the given item, returns the list of
+# enclosure URLs
+def store_enclosures(c, item_id, entry):
+    urls = []
+    for enclosure in entry.get('enclosures', []):
+        url = enclosure.get('href')
+        if not url:
+            continue
+        try:
+            length = int(enclosure.get('length'))
+        except (TypeError, ValueError):
+            length = None
+        c.execute("INSERT INTO enclosure(item, url, type, length) VALUES (?, ?, ?, ?)", (item_id, url, enclosure.get('type'), length))
+        urls.append(url)
+    return urls
+
+
+# Updates the feed_stats summary of a feed after an update. Takes the
+# publication timestamps of the newly inserted items and the duration of the
+# update in seconds.
+def update_feed_stats(c, feed, now, inserted, duration):
+    c.execute("INSERT OR IGNORE INTO feed_stats(feed) VALUES (?)", (feed.key,))
+    c.execute("""
+        UPDATE feed_stats SET
+            item_count = item_count + :count,
+            newest_published = CASE
+                WHEN :newest IS NULL THEN newest_published
+                WHEN newest_published IS NULL OR datetime(:newest, 'unixepoch') > newest_published THEN datetime(:newest, 'unixepoch')
+                ELSE newest_published
+            END,
+            last_new_item = CASE WHEN :count > 0 THEN datetime(:now, 'unixepoch') ELSE last_new_item END,
+            last_fetch_duration = :duration
+        WHERE feed = :feed""", {
+        'feed': feed.key,
+        'count': len(inserted),
+        'newest': max(inserted) if inserted else None,
+        'now': now.replace(tzinfo=datetime.timezone.utc).timestamp(),
+        'duration': duration,
+    })
+
+
+#
+# Fetch cache
+#
+
+class FetchCacheError(GlassballError):
+    pass
+
+
+# The number of seconds to wait for a feed to respond when fetching through the
+# fetch cache
+FETCH_TIMEOUT = 60
+
+
+# Decompresses a response body according to its Content-Encoding header, and
+# drops the headers that describe the compressed body
+def decode_body(body, headers):
+    encoding = None
+    for name in list(headers):
+        if name.lower() == 'content-encoding':
+            encoding = headers.pop(name).strip().lower()
+        elif name.lower() == 'content-length':
+            del headers[name]
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'deflate':
+        # Servers send both zlib-wrapped and raw deflate data
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+# Records the status code of the first redirect followed during a request, so
+# redirects can be reported the same way feedparser does
+class RecordingRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def __init__(self):
+        super().__init__()
+        self.status = None
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if self.status is None:
+            self.status = code
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# A directory of raw feed responses, keyed by feed URL. Each response is stored
+# as a body file and a JSON file with the status, final URL and headers. Only
+# successful responses are stored, so the cache keeps the last good response of
+# each feed. The cache is bounded in size by evicting the least recently used
+# responses once per update.
+class FetchCache:
+    def __init__(self, path, max_size, timeout=FETCH_TIMEOUT):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+
+    def _files(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return self.path / (name + '.json'), self.path / (name + '.body')
+
+    # Retrieves the URL, stores the response in the cache if it succeeded, and
+    # returns the parsed feed
+    def fetch(self, url):
+        # Only HTTP responses are cached, anything else feedparser accepts
+        # (such as local files) is left to feedparser
+        if not re.match(r'https?://', url, re.IGNORECASE):
+            return feedparser.parse(url)
+
+        redirects = RecordingRedirectHandler()
+        opener = urllib.request.build_opener(redirects)
+        try:
+            # Like feedparser, we accept compressed responses, the cache
+            # stores them decompressed
+            request = urllib.request.Request(url, headers={'User-Agent': feedparser.USER_AGENT, 'Accept-Encoding': 'gzip, deflate'})
+            try:
+                response = opener.open(request, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                # HTTP errors still carry a response worth parsing
+                response = e
+            with response:
+                headers = dict(response.headers.items())
+                body = decode_body(response.read(), headers)
+                meta = {
+                    'url': url,
+                    'href': response.geturl(),
+                    'status': redirects.status or response.getcode(),
+                    'headers': headers,
+                    'fetched': datetime.datetime.utcnow().isoformat(),
+                }
+        except (urllib.error.URLError, http.client.HTTPException, OSError, ValueError, zlib.error) as e:
+            # Mimic feedparser's result for requests that did not get any
+            # response at all
+            return feedparser.FeedParserDict(bozo=1, bozo_exception=e, entries=[], feed=feedparser.FeedParserDict())
+
+        # Responses without feed data (such as 304 Not Modified or error
+        # pages) must not replace the last good response
+        if 200 <= response.getcode() < 300:
+            self.store(meta, body)
+        return self.parse(meta, body)
+
+    # Returns the parsed feed for the cached response for the URL
+    def load(self, url):
+        meta_file, body_file = self._files(url)
+        if not meta_file.exists() or not body_file.exists():
+            raise FetchCacheError("No cached response for '{}'".format(url))
+        meta = json.loads(meta_file.read_text(encoding='utf-8'))
+        body = body_file.read_bytes()
+        # Mark the response as recently used
+        for f in (meta_file, body_file):
+            f.touch()
+        return self.parse(meta, body)
+
+    def parse(self, meta, body):
+        # Lower-case header names as feedparser expects them
+        headers = {k.lower(): v for k, v in meta['headers'].items()}
+        with profile_phase('parse'):
+            result = feedparser.parse(body, response_headers=headers)
+        result['status'] = meta['status']
+        result['href'] = meta['href']
+        result['headers'] = headers
+        return result
+
+    def store(self, meta, body):
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+        meta_file, body_file = self._files(meta['url'])
+        body_file.write_bytes(body)
+        meta_file.write_text(json.dumps(meta), encoding='utf-8')
+
+    # Removes least recently used responses until the cache fits its size
+    def evict(self):
+        # Nothing was ever stored if no feed was retrieved successfully
+        if not self.path.exists():
+            return
+        entries = {}
+        for f in self.path.iterdir():
+            if f.suffix in ('.json', '.body'):
+                stat = f.stat()
+                size, used, files = entries.get(f.stem, (0, 0, []))
+                entries[f.stem] = (size + stat.st_size, max(used, stat.st_mtime), files + [f])
+        total = sum(size for size, _, _ in entries.values())
+        for size, _, files in sorted(entries.values(), key=lambda e: e[1]):
+            if total <= self.max_size:
+                break
+            for f in files:
+                f.unlink()
+            total -= size
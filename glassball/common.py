@@ -11,14 +11,17 @@
 # 4. Name munging utilities
 # 5. User's hooks utilities
 # 6. Configuration parsing utilities
+# 7. Profiling utilities
 #
 
 #
 # 0. Imports
 #
 
+import collections
 import configparser
 import contextlib
+import cProfile
 import datetime
 import os
 import os.path
@@ -29,6 +32,9 @@ import shlex
 import sqlite3
 import subprocess
 import sys
+import threading
+import uuid
+import zlib
 
 
 #
@@ -124,12 +130,127 @@ def open_database(db_file):
     return conn
 
 
+# Creates a new database with the current schema and a fresh database id
+def create_database(db_file):
+    with open_database(db_file) as conn:
+        conn.executescript(get_resource_string('schema.sql'))
+        conn.execute("INSERT INTO database_id VALUES(?)", (str(uuid.uuid4()),))
+
+
+# Upgrade scripts to bring databases created by earlier versions up to date
+# with schema.sql. The script at index N upgrades a database with schema
+# version N (as stored in `PRAGMA user_version`) to version N + 1.
+SCHEMA_UPGRADES = [
+    # 0 -> 1: Item fingerprints and additional feed memberships
+    """
+    ALTER TABLE item ADD COLUMN link_fingerprint TEXT;
+    ALTER TABLE item ADD COLUMN content_fingerprint TEXT;
+    CREATE INDEX item_link_fingerprint ON item(link_fingerprint);
+    CREATE INDEX item_content_fingerprint ON item(content_fingerprint);
+    CREATE TABLE item_feed (
+        item INTEGER NOT NULL REFERENCES item(id),
+        feed TEXT NOT NULL,
+        PRIMARY KEY (item, feed)
+    );
+    """,
+    # 1 -> 2: Per-feed summary, filled from the existing items
+    """
+    CREATE INDEX item_feed_published ON item(feed, published);
+    CREATE TABLE feed_stats (
+        feed TEXT NOT NULL PRIMARY KEY,
+        item_count INTEGER NOT NULL DEFAULT 0,
+        newest_published TEXT,
+        last_new_item TEXT,
+        last_fetch_duration REAL
+    );
+    INSERT INTO feed_stats(feed, item_count, newest_published)
+        SELECT feed, count(*), max(published) FROM (
+            SELECT feed, published FROM item
+            UNION ALL
+            SELECT m.feed, i.published FROM item_feed m JOIN item i ON i.id = m.item
+        ) GROUP BY feed;
+    """,
+    # 2 -> 3: Item enclosures
+    """
+    CREATE TABLE enclosure (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item INTEGER NOT NULL REFERENCES item(id),
+        url TEXT NOT NULL,
+        type TEXT,
+        length INTEGER,
+        cached TEXT
+    );
+    CREATE INDEX enclosure_item ON enclosure(item);
+    """,
+    # 3 -> 4: Publication order of all items
+    """
+    CREATE INDEX item_published ON item(published);
+    """,
+    # 4 -> 5: Recount the feed summaries, including the items of other feeds
+    # the feeds share through additional memberships
+    """
+    INSERT OR IGNORE INTO feed_stats(feed) SELECT feed FROM item UNION SELECT feed FROM item_feed;
+    UPDATE feed_stats SET
+        item_count = (SELECT count(*) FROM item WHERE feed = feed_stats.feed) + (SELECT count(*) FROM item_feed WHERE feed = feed_stats.feed),
+        newest_published = (SELECT max(published) FROM (
+            SELECT published FROM item WHERE feed = feed_stats.feed
+            UNION ALL
+            SELECT i.published FROM item_feed m JOIN item i ON i.id = m.item WHERE m.feed = feed_stats.feed
+        ));
+    """,
+]
+
+
+# Applies any outstanding schema upgrades to the database
+def upgrade_database(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for i, script in enumerate(SCHEMA_UPGRADES[version:], start=version):
+        conn.executescript(script)
+        conn.execute('PRAGMA user_version = {}'.format(i + 1))
+
+
+# Records the membership of an existing item in an additional feed, and counts
+# the item in the feed's summary if it was not a member yet
+def add_item_membership(c, item_id, feed_key):
+    c.execute("INSERT OR IGNORE INTO item_feed(item, feed) VALUES (?, ?)", (item_id, feed_key))
+    if c.rowcount != 1:
+        return
+    c.execute("INSERT OR IGNORE INTO feed_stats(feed) VALUES (?)", (feed_key,))
+    c.execute("""
+        UPDATE feed_stats SET
+            item_count = item_count + 1,
+            newest_published = max(coalesce(newest_published, ''), (SELECT published FROM item WHERE id = :item))
+        WHERE feed = :feed""", {
+        'item': item_id,
+        'feed': feed_key,
+    })
+
+
 # Convert database-origin moment in "YYYY-MM-DD HH:MM:SS" format to datetime
 # instances
 def db_datetime(value):
     return datetime.datetime(*map(int, value.replace(' ', '-').replace(':','-').split('-')))
 
 
+# Convert item content to its database representation, content larger than the
+# given threshold is stored as a zlib-compressed blob
+def content_to_db(value, compress_threshold=None):
+    if value is None or compress_threshold is None:
+        return value
+    data = value.encode('utf-8')
+    if len(data) < compress_threshold:
+        return value
+    return zlib.compress(data)
+
+
+# Convert database-origin item content to a string, transparently
+# decompressing content that was stored compressed
+def db_content(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+
 #
 # 4. Name munging utilities
 #
@@ -141,13 +262,24 @@ def slugify(s):
     return s
 
 
-def find_free_name(candidate, existing_names):
-    name = candidate
-    i = 1
-    while name in existing_names:
-        i += 1
-        name = "{}--{}".format(candidate, i)
-    return name
+# Allocates unique names by adding a numeric suffix (`name--2`, `name--3`, ...)
+# to candidates that are already in use. Remembers the last suffix used for
+# each candidate, so allocating many similar names does not require probing
+# all previously allocated suffixes again.
+class NameAllocator:
+    def __init__(self, existing_names=()):
+        self.names = set(existing_names)
+        self._suffixes = {}
+
+    def allocate(self, candidate):
+        i = self._suffixes.get(candidate, 1)
+        name = candidate if i == 1 else "{}--{}".format(candidate, i)
+        while name in self.names:
+            i += 1
+            name = "{}--{}".format(candidate, i)
+        self._suffixes[candidate] = i
+        self.names.add(name)
+        return name
 
 
 #
@@ -179,9 +311,10 @@ class list_hook_var:
 
 def run_hook(hook_name, working_dir, command_string, replacements, environment):
     # Set up inherited environment variables by adding given environment to copy
-    # of current environment
+    # of current environment, variables without a value are set empty like
+    # placeholders without a value
     new_env = dict(os.environ)
-    new_env.update(environment)
+    new_env.update((key, value if value is not None else '') for key, value in environment.items())
 
     # Build up command by splitting the command string (in a semi-platform-aware
     # manner), and then replacing any placeholder tokens while keeping the
@@ -217,7 +350,8 @@ def run_hook(hook_name, working_dir, command_string, replacements, environment):
         # Switch the working directory so looking up the hook command works the
         # way the caller (and the user) expects
         with working_directory(working_dir):
-            result = subprocess.run(command, env=new_env, check=True)
+            with profile_phase('hooks'):
+                result = subprocess.run(command, env=new_env, check=True)
     except subprocess.CalledProcessError as e:
         # For now, we simply pass on the hook's output directly, since we do the
         # same when the hook runs successfully (this might be changed to offer
@@ -268,14 +402,33 @@ def parse_update_interval(user_input):
     return datetime.timedelta(**arguments)
 
 
+def parse_size(user_input):
+    # Unit multipliers, the bare number is taken to be in bytes
+    units = {'': 1, 'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+
+    # Split the input into an amount and an optional unit
+    match = re.fullmatch(r'\s*(\d+)\s*([a-zA-Z]*)\s*', user_input)
+    if not match:
+        raise ValueError("Cannot parse size '{}'".format(user_input))
+    user_amount, user_unit = match.groups()
+    unit = user_unit.lower()
+    if unit not in units:
+        raise ValueError("Unknown size unit '{}' in '{}'".format(user_unit, user_input))
+    return int(user_amount) * units[unit]
+
+
 class Feed:
-    def __init__(self, key, title, url, update_interval, accept_bozo, inject_style_file):
+    def __init__(self, key, title, url, update_interval, accept_bozo, inject_style_file, prefer_content=False, max_data_uri_size=None, max_content_size=None, compress_content_size=None):
         self.key = key
         self.title = title
         self.url = url
         self.update_interval = update_interval
         self.accept_bozo = accept_bozo
         self.inject_style_file = inject_style_file
+        self.prefer_content = prefer_content
+        self.max_data_uri_size = max_data_uri_size
+        self.max_content_size = max_content_size
+        self.compress_content_size = compress_content_size
 
     @property
     def config_section(self):
@@ -313,6 +466,7 @@ class Configuration:
                 update_interval = self._config.get(section, 'update interval', fallback='1 hour')
                 accept_bozo = self._config.getboolean(section, 'accept bozo data', fallback=False)
                 inject_style_file = self._config.get(section, 'style file', fallback=None)
+                prefer_content = self._config.getboolean(section, 'prefer content', fallback=False)
             except configparser.Error as e:
                 raise ConfigurationError("Misconfiguration feed in '{}': {}".format(str(self.configuration_file), e)) from e
             # Parse update interval for feed
@@ -320,8 +474,20 @@ class Configuration:
                 update_interval = parse_update_interval(update_interval)
             except ValueError as e:
                 raise ConfigurationError("Cannot understand update interval '{}' for feed '{}' in '{}'".format(update_interval, section, str(self.configuration_file)))
+            # Parse content size limits for feed
+            sizes = {}
+            for option in ['max data uri size', 'max content size', 'compress content size']:
+                value = self._config.get(section, option, fallback=None)
+                try:
+                    sizes[option] = parse_size(value) if value is not None else None
+                except ValueError as e:
+                    raise ConfigurationError("Cannot understand {} '{}' for feed '{}' in '{}'".format(option, value, section, str(self.configuration_file)))
             # Store feed information in private collection
-            self._feeds[key] = Feed(key, title, url, update_interval, accept_bozo, inject_style_file)
+            self._feeds[key] = Feed(key, title, url, update_interval, accept_bozo, inject_style_file,
+                prefer_content=prefer_content,
+                max_data_uri_size=sizes['max data uri size'],
+                max_content_size=sizes['max content size'],
+                compress_content_size=sizes['compress content size'])
 
     @classmethod
     def exists(cls, ini_file):
@@ -356,6 +522,49 @@ class Configuration:
     def on_update(self):
         return self._config.get('global', 'on update', fallback=None)
 
+    @property
+    def fetch_cache_path(self):
+        path = self._config.get('global', 'fetch cache', fallback=None)
+        return self.relative_path(path) if path else None
+
+    @property
+    def fetch_cache_size(self):
+        value = self._config.get('global', 'fetch cache size', fallback='100 MB')
+        try:
+            return parse_size(value)
+        except ValueError as e:
+            raise ConfigurationError("Cannot understand fetch cache size '{}' in '{}': {}".format(value, str(self.configuration_file), e)) from e
+
+    @property
+    def export_items(self):
+        try:
+            return self._config.getint('global', 'export items', fallback=None)
+        except ValueError as e:
+            raise ConfigurationError("Cannot understand export items setting in '{}': {}".format(str(self.configuration_file), e)) from e
+
+    @property
+    def media_path(self):
+        return self.build_path / 'media'
+
+    @property
+    def media_url(self):
+        return self._config.get('global', 'media url', fallback=None)
+
+    @property
+    def media_cache_size(self):
+        value = self._config.get('global', 'media cache size', fallback='1 GB')
+        try:
+            return parse_size(value)
+        except ValueError as e:
+            raise ConfigurationError("Cannot understand media cache size '{}' in '{}': {}".format(value, str(self.configuration_file), e)) from e
+
+    @property
+    def collapse_duplicates(self):
+        try:
+            return self._config.getboolean('global', 'collapse duplicates', fallback=False)
+        except ValueError as e:
+            raise ConfigurationError("Cannot understand collapse duplicates setting in '{}': {}".format(str(self.configuration_file), e)) from e
+
     # Actions for the configuration
     def run_hook(self, section, hook, *, replacements={}, environment={}):
         command_string = self._config.get(section, hook, fallback=None)
@@ -370,4 +579,99 @@ class Configuration:
     def open_database(self):
         if not self.database_file.exists():
             raise ConfigurationError("Database file '{}' does not exists".format(str(self.database_file)))
-        return open_database(self.database_file)
+        conn = open_database(self.database_file)
+        upgrade_database(conn)
+        return conn
+
+
+#
+# 7. Profiling utilities
+#
+
+# The phases of work that can be profiled on their own
+PROFILE_PHASES = ['fetch', 'parse', 'db', 'hooks', 'render']
+
+
+# Samples the call stack of a thread at a fixed interval while active, to
+# produce collapsed stacks as used by flamegraph tools
+class StackSampler:
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.active = False
+        self.counts = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if not self.active:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno).replace(';', ':'))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(str(path), 'w', encoding='utf-8') as f:
+            for stack, count in self.counts.most_common():
+                print("{} {}".format(stack, count), file=f)
+
+
+# Profiles the current thread with cProfile and a stack sampler, either for
+# the whole run or only during one phase of work
+class Profiler:
+    def __init__(self, phase=None):
+        self.phase = phase
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident())
+        self._depth = 0
+
+    def enable(self):
+        self._depth += 1
+        if self._depth == 1:
+            self.profile.enable()
+            self.sampler.active = True
+
+    def disable(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self.sampler.active = False
+            self.profile.disable()
+
+    # Writes `<prefix>.pstats` and `<prefix>.collapsed`, returns the paths
+    def write(self, prefix):
+        self.sampler.stop()
+        pstats_file = prefix + '.pstats'
+        collapsed_file = prefix + '.collapsed'
+        self.profile.dump_stats(pstats_file)
+        self.sampler.write(collapsed_file)
+        return pstats_file, collapsed_file
+
+
+# The profiler in use, if any
+active_profiler = None
+
+
+# Profiles the enclosed work if the active profiler is profiling the named
+# phase
+@contextlib.contextmanager
+def profile_phase(name):
+    profiler = active_profiler
+    if profiler is None or profiler.phase != name:
+        yield
+        return
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
@@ -20,5 +20,49 @@ CREATE TABLE item (
     link TEXT,
     title TEXT,
     author TEXT,
-    content TEXT
+    content TEXT,
+
+    link_fingerprint TEXT,
+    content_fingerprint TEXT
 );
+
+CREATE INDEX item_link_fingerprint ON item(link_fingerprint);
+CREATE INDEX item_content_fingerprint ON item(content_fingerprint);
+CREATE INDEX item_feed_published ON item(feed, published);
+CREATE INDEX item_published ON item(published);
+
+
+-- Additional feed memberships for items that appeared in several feeds
+CREATE TABLE item_feed (
+    item INTEGER NOT NULL REFERENCES item(id),
+    feed TEXT NOT NULL,
+    PRIMARY KEY (item, feed)
+);
+
+
+-- Per-feed summary, maintained during updates
+CREATE TABLE feed_stats (
+    feed TEXT NOT NULL PRIMARY KEY,
+    item_count INTEGER NOT NULL DEFAULT 0,
+    newest_published TEXT,
+    last_new_item TEXT,
+    last_fetch_duration REAL
+);
+
+
+-- Enclosures (media files) of items, with the file name of the local copy in
+-- the media cache if it has been downloaded
+CREATE TABLE enclosure (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    item INTEGER NOT NULL REFERENCES item(id),
+    url TEXT NOT NULL,
+    type TEXT,
+    length INTEGER,
+    cached TEXT
+);
+
+CREATE INDEX enclosure_item ON enclosure(item);
+
+
+-- Schema version, see `SCHEMA_UPGRADES` in common.py
+PRAGMA user_version = 5;
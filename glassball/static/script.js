@@ -14,6 +14,24 @@ void function() {
     }
 
 
+    /*
+    ** Shared state
+    */
+
+    // The read info currently in use, loaded once from storage when the
+    // document is ready and kept in memory afterwards
+    var readInfo = null;
+
+    // The feed keys for every item id on the page
+    var itemFeeds = new Map();
+
+    // Unread counters, maintained incrementally as items change state
+    var unreadCounts = {
+        total: 0,
+        feeds: new Map()
+    };
+
+
     /*
     ** Filter predicates
     */
@@ -27,11 +45,10 @@ void function() {
         feed: function(options) {
             var feed = options.feed;
             return function(e) {
-                return e.dataset.feed == feed;
+                return e.dataset.feeds.split(' ').indexOf(feed) != -1;
             };
         },
         unread: function(options) {
-            var readInfo = getReadInfo();
             return function(e) {
                 return isUnread(readInfo, e.dataset.item);
             };
@@ -53,48 +70,80 @@ void function() {
 
     // Update the read/unread status of all `.item` elements for the given item
     // id
-    function uiReadStatus(readInfo, id) {
+    function uiReadStatus(id) {
         var unread = isUnread(readInfo, id);
         document.querySelectorAll('.item[data-item="' + id + '"]').forEach(function(el) {
             el.classList.toggle('item--unread', unread);
         });
-        uiUnreadCount();
     }
 
     // Update the unread counters of all ui elements asking for them
     function uiUnreadCount() {
-        var unread = new Set();
-        var unreadFeeds = new Map();
-
-        document.querySelectorAll('.item.item--unread').forEach(function(el) {
-            if(!unread.has(el.dataset.item)) {
-                unread.add(el.dataset.item);
-                var feed = el.dataset.feed;
-                if(!unreadFeeds.has(feed)) {
-                    unreadFeeds.set(feed, 1);
-                } else {
-                    unreadFeeds.set(feed, unreadFeeds.get(feed) + 1);
-                }
-            }
-        });
         document.querySelectorAll('[data-unread-count]').forEach(function(el) {
+            var unreadCount;
             if(el.dataset.unreadCount == '*') {
-                el.classList.toggle('hidden', unread.size == 0);
-                el.textContent = '' + unread.size;
+                unreadCount = unreadCounts.total;
             } else {
-                var unreadCount = unreadFeeds.get(el.dataset.unreadCount);
-                el.classList.toggle('hidden', typeof unreadCount == 'undefined');
-                el.textContent = '' + unreadCount;
+                unreadCount = unreadCounts.feeds.get(el.dataset.unreadCount) || 0;
             }
+            el.classList.toggle('hidden', unreadCount == 0);
+            el.textContent = '' + unreadCount;
         });
     }
 
 
+    /*
+    ** Unread counters
+    */
+
+    // Recounts all unread items on the page, this is only needed when the
+    // page is first set up
+    function countUnread() {
+        unreadCounts.total = 0;
+        unreadCounts.feeds.clear();
+        itemFeeds.forEach(function(feeds, id) {
+            if(isUnread(readInfo, id)) {
+                adjustUnreadCount(id, 1);
+            }
+        });
+    }
+
+    // Adjusts the unread counters for the feeds of the given item id
+    function adjustUnreadCount(id, delta) {
+        unreadCounts.total += delta;
+        itemFeeds.get(id).forEach(function(feed) {
+            unreadCounts.feeds.set(feed, (unreadCounts.feeds.get(feed) || 0) + delta);
+        });
+    }
+
+    // Sets the read status for the given item id and keeps the counters up to
+    // date with the change, the item elements are left to the caller
+    function updateReadStatus(id, read) {
+        var wasRead = isRead(readInfo, id);
+        if(wasRead == read) {
+            return;
+        }
+        if(read) {
+            markAsRead(readInfo, id);
+        } else {
+            markAsUnread(readInfo, id);
+        }
+        adjustUnreadCount(id, read ? -1 : 1);
+    }
+
+    // Sets the read status for the given item id and keeps the counters and
+    // the item elements up to date with the change
+    function setReadStatus(id, read) {
+        updateReadStatus(id, read);
+        uiReadStatus(id);
+    }
+
+
     /*
     ** Event handlers
     */
 
-    document.addEventListener('DOMContentLoaded', function() {
+    function setupEventHandlers() {
         // Event handlers for item elements
         items().forEach(function(el) {
             // Clicking on the item element
@@ -106,9 +155,8 @@ void function() {
                 document.querySelector('#item-view').src = 'items/' + el.dataset.item + '.html';
 
                 // Mark the item as read
-                var readInfo = getReadInfo();
-                markAsRead(readInfo, el.dataset.item);
-                uiReadStatus(readInfo, el.dataset.item);
+                setReadStatus(el.dataset.item, true);
+                uiUnreadCount();
                 storeReadInfo(readInfo);
             });
 
@@ -118,13 +166,8 @@ void function() {
                 e.stopPropagation();
 
                 // Mark the item as the inverted status
-                var readInfo = getReadInfo();
-                if(isRead(readInfo, el.dataset.item)) {
-                    markAsUnread(readInfo, el.dataset.item);
-                } else {
-                    markAsRead(readInfo, el.dataset.item);
-                }
-                uiReadStatus(readInfo, el.dataset.item);
+                setReadStatus(el.dataset.item, !isRead(readInfo, el.dataset.item));
+                uiUnreadCount();
                 storeReadInfo(readInfo);
             });
         });
@@ -154,9 +197,9 @@ void function() {
                     highest = Math.max(highest, parseInt(el.dataset.item));
                     el.classList.remove('item--unread');
                 });
-                // Update the read info data
-                var readInfo = getReadInfo();
+                // Update the read info data, everything is read now
                 markAllAsRead(readInfo, highest);
+                countUnread();
                 storeReadInfo(readInfo);
                 uiUnreadCount();
             });
@@ -166,21 +209,21 @@ void function() {
         document.querySelectorAll('button[value="mark-filtered"]').forEach(function(el) {
             // Click on the button
             el.addEventListener('click', function() {
-                var readInfo = getReadInfo();
                 items().forEach(function(el) {
                     // Item is filtered, so we ignore it
                     if(el.classList.contains('hidden')) {
                         return;
                     }
-                    // Mark the current item as read, and update the UI
-                    markAsRead(readInfo, el.dataset.item);
+                    // Mark the current item as read, and update its element
+                    // directly rather than looking it up again
+                    updateReadStatus(el.dataset.item, true);
                     el.classList.remove('item--unread');
                 });
                 storeReadInfo(readInfo);
                 uiUnreadCount();
             });
         });
-    });
+    }
 
 
     /*
@@ -200,16 +243,20 @@ void function() {
     the read info uses a compact representation. Unread handling is based on a
     data structure called read info. Read info consists of three fields:
 
-        { readThreshold: 0, readSet: [], unreadSet: [] }
+        { readThreshold: 0, readSet: Set(), unreadSet: Set() }
 
     The `readThreshold` is used to indicate the default state of a news item.
     All items for which `id < readThreshold` holds are considered read, and all
     items for which `id >= readThreshold` holds are considered unread.
 
-    To allow arbitrary assignment of read/unread status, the two arrays of items
+    To allow arbitrary assignment of read/unread status, the two sets of items
     called `readSet` and `unreadSet` are used to override the item state derived
     from the `readThreshold`. Any items listed in `readSet` are considered read,
     and any items listed in `unreadSet` are considered unread.
+
+    In storage, both sets are range encoded: a set is stored as a sorted list
+    of `[first, last]` pairs of consecutive ids. Since items tend to be read in
+    runs, this keeps the stored read info small even with many overrides.
     */
 
     /*
@@ -219,41 +266,166 @@ void function() {
     concept.
     */
 
-    // Initializes local storage with a "nothing is read" state
-    function initLocalStorage() {
-        storeReadInfo({
+    // Creates a read info with a "nothing is read" state
+    function emptyReadInfo() {
+        return {
             readThreshold: 1,
             readSet: new Set(),
             unreadSet: new Set()
+        };
+    }
+
+    // Encodes a set of ids as a sorted list of inclusive ranges
+    function encodeRanges(set) {
+        var ids = Array.from(set).sort(function(a, b) { return a - b; });
+        var ranges = [];
+        ids.forEach(function(id) {
+            var last = ranges[ranges.length - 1];
+            if(last && last[1] + 1 == id) {
+                last[1] = id;
+            } else {
+                ranges.push([id, id]);
+            }
+        });
+        return ranges;
+    }
+
+    // Decodes a list of inclusive ranges into a set of ids
+    function decodeRanges(ranges) {
+        var set = new Set();
+        (ranges || []).forEach(function(range) {
+            for(var id = range[0]; id <= range[1]; id++) {
+                set.add(id);
+            }
         });
+        return set;
+    }
+
+    // Converts a read info to its stored form
+    function encodeReadInfo(readInfo) {
+        return {
+            databaseId: databaseId,
+            readThreshold: readInfo.readThreshold,
+            readRanges: encodeRanges(readInfo.readSet),
+            unreadRanges: encodeRanges(readInfo.unreadSet)
+        };
     }
 
-    // Retrieves the current read info from local storage
-    function getReadInfo() {
+    // Converts a stored read info back, giving an empty read info if the
+    // stored form is missing or belongs to a different database
+    function decodeReadInfo(record) {
+        if(!record || record.databaseId != databaseId) {
+            return emptyReadInfo();
+        }
         return {
-            readThreshold: parseInt(window.localStorage.getItem('readThreshold')),
-            readSet: new Set(JSON.parse(window.localStorage.getItem('readSet'))),
-            unreadSet: new Set(JSON.parse(window.localStorage.getItem('unreadSet')))
+            readThreshold: record.readThreshold,
+            readSet: decodeRanges(record.readRanges),
+            unreadSet: decodeRanges(record.unreadRanges)
+        };
+    }
+
+    // Retrieves the read info stored by older versions of the viewer in local
+    // storage (if any) and removes it from local storage
+    function takeLegacyReadInfo() {
+        var storage = window.localStorage;
+        if(storage.getItem('databaseId') != databaseId || storage.getItem('readThreshold') === null) {
+            return null;
+        }
+        var readInfo = {
+            readThreshold: parseInt(storage.getItem('readThreshold')),
+            readSet: new Set(JSON.parse(storage.getItem('readSet'))),
+            unreadSet: new Set(JSON.parse(storage.getItem('unreadSet')))
+        };
+        ['databaseId', 'readThreshold', 'readSet', 'unreadSet'].forEach(function(key) {
+            storage.removeItem(key);
+        });
+        return readInfo;
+    }
+
+
+    /*
+    ** Read info storage
+    */
+
+    /*
+    The read info is stored in IndexedDB as a single record. If IndexedDB is
+    not available (some browsers disable it for local files or private
+    windows), the same record is stored in local storage instead.
+    */
+
+    var storeName = 'readInfo';
+    var recordKey = 'readInfo';
+
+    // Opens the IndexedDB database, calling back with `null` if that fails
+    function openStorage(callback) {
+        if(!window.indexedDB) {
+            callback(null);
+            return;
+        }
+        var request;
+        try {
+            request = window.indexedDB.open('glassball', 1);
+        } catch(e) {
+            callback(null);
+            return;
+        }
+        request.onupgradeneeded = function() {
+            request.result.createObjectStore(storeName);
+        };
+        request.onsuccess = function() {
+            callback(request.result);
+        };
+        request.onerror = function() {
+            callback(null);
         };
     }
 
-    // Store a read info to local storage
+    // The opened IndexedDB database, or `null` to use local storage
+    var storage = null;
+
+    // Retrieves the current read info from storage
+    function loadReadInfo(callback) {
+        openStorage(function(db) {
+            storage = db;
+            var legacy = takeLegacyReadInfo();
+            if(legacy) {
+                storeReadInfo(legacy);
+                callback(legacy);
+            } else if(!storage) {
+                callback(decodeReadInfo(JSON.parse(window.localStorage.getItem(recordKey))));
+            } else {
+                var request = storage.transaction(storeName).objectStore(storeName).get(recordKey);
+                request.onsuccess = function() {
+                    callback(decodeReadInfo(request.result));
+                };
+                request.onerror = function() {
+                    callback(emptyReadInfo());
+                };
+            }
+        });
+    }
+
+    // Store a read info to storage
     function storeReadInfo(readInfo) {
         compactReadInfo(readInfo);
-        window.localStorage.setItem('readThreshold', readInfo.readThreshold);
-        window.localStorage.setItem('readSet', JSON.stringify(Array.from(readInfo.readSet)));
-        window.localStorage.setItem('unreadSet', JSON.stringify(Array.from(readInfo.unreadSet)));
+        var record = encodeReadInfo(readInfo);
+        if(!storage) {
+            window.localStorage.setItem(recordKey, JSON.stringify(record));
+        } else {
+            storage.transaction(storeName, 'readwrite').objectStore(storeName).put(record, recordKey);
+        }
     }
 
     // Compacts a read info in place
     function compactReadInfo(readInfo) {
-        // Clean up read/unread sets by dropping duplicate items, filtering out
-        // anything already indicated by the readThreshold, and sorting them
-        function filterSet(set, pred) {
-            return new Set(Array.from(set).filter(pred));
-        }
-        readInfo.readSet = filterSet(readInfo.readSet, function(a){ return a >= readInfo.readThreshold });
-        readInfo.unreadSet = filterSet(readInfo.unreadSet, function(a){ return a < readInfo.readThreshold });
+        // Clean up read/unread sets by filtering out anything already
+        // indicated by the readThreshold
+        readInfo.readSet.forEach(function(id) {
+            if(id < readInfo.readThreshold) readInfo.readSet.delete(id);
+        });
+        readInfo.unreadSet.forEach(function(id) {
+            if(id >= readInfo.readThreshold) readInfo.unreadSet.delete(id);
+        });
 
         // If both sets are empty, we are done, since we cannot make the
         // representation any more compact
@@ -262,67 +434,41 @@ void function() {
         }
 
         // Determine highest and lowest thresholds we are interested in
-        var combined = Array.from(readInfo.readSet).concat(Array.from(readInfo.unreadSet), [readInfo.readThreshold]);
-        var low = Math.min.apply(null, combined) - 1;
-        var high = Math.max.apply(null, combined) + 1;
-        // Make sure that low does not go below 0
-        low = Math.max(low, 1);
-
-        // Create a working copy of the read info
-        var working = {
-            readThreshold: readInfo.readThreshold,
-            readSet: new Set(readInfo.readSet),
-            unreadSet: new Set(readInfo.unreadSet)
-        };
-
-        // Stores the working copy to the actual read info
-        function storeWorking() {
-            readInfo.readThreshold = working.readThreshold;
-            readInfo.readSet = new Set(working.readSet);
-            readInfo.unreadSet = new Set(working.unreadSet);
-        }
-
-        // Moves the read threshold down one place in the working copy
-        function down(info) {
-            var newT = Math.max(info.readThreshold - 1, 1);
-            if(info.readThreshold == newT) return;
-            if(info.unreadSet.has(newT)) {
-                info.unreadSet.delete(newT);
-            } else {
-                info.readSet.add(newT);
-            }
-            info.readThreshold = newT;
-        }
-
-        // Moves the read threshold up one place in the working copy
-        function up(info) {
-            var newT = info.readThreshold + 1;
-            if(info.readSet.has(info.readThreshold)) {
-                info.readSet.delete(info.readThreshold);
-            } else {
-                info.unreadSet.add(info.readThreshold);
+        var low = readInfo.readThreshold;
+        var high = readInfo.readThreshold;
+        readInfo.readSet.forEach(function(id) { high = Math.max(high, id + 1); });
+        readInfo.unreadSet.forEach(function(id) { low = Math.min(low, id); });
+
+        // Sweep the threshold from low to high, keeping track of the number
+        // of overrides needed: every id the threshold passes either loses its
+        // override (if it was read) or needs one (if it was unread). The
+        // number of overrides at `low` is the number of read ids between low
+        // and high.
+        var cost = readInfo.readSet.size + (readInfo.readThreshold - low - readInfo.unreadSet.size);
+        var best = cost;
+        var bestThreshold = low;
+        for(var t = low; t < high; t++) {
+            cost += isRead(readInfo, t) ? -1 : 1;
+            if(cost <= best) {
+                best = cost;
+                bestThreshold = t + 1;
             }
-            info.readThreshold = newT;
-        }
-
-        // Move down to the lowest threshold of interest
-        while(working.readThreshold != low) {
-            down(working);
         }
 
-        // Determine current score and store working state to actual
-        var best = working.readSet.size + working.unreadSet.size;
-        storeWorking();
-
-        // Move up to the highest threshold of interest, and store the most
-        // compact variant so far in the actual read info
-        while(working.readThreshold != high) {
-            up(working);
-            if(working.readSet.size + working.unreadSet.size <= best) {
-                best = working.readSet.size + working.unreadSet.size;
-                storeWorking();
+        // Move the threshold to the most compact position, moving ids passed
+        // by the threshold into the appropriate override set
+        var old = readInfo.readThreshold;
+        for(var id = Math.min(old, bestThreshold); id < Math.max(old, bestThreshold); id++) {
+            var read = isRead(readInfo, id);
+            readInfo.readSet.delete(id);
+            readInfo.unreadSet.delete(id);
+            if(id < bestThreshold && !read) {
+                readInfo.unreadSet.add(id);
+            } else if(id >= bestThreshold && read) {
+                readInfo.readSet.add(id);
             }
         }
+        readInfo.readThreshold = bestThreshold;
     }
 
     // Mutates the read info by marking the id as read
@@ -366,21 +512,23 @@ void function() {
         return !isRead(readInfo, id);
     }
 
-    // When the document is ready, initialize the storage and update the UI
+    // When the document is ready, load the read info, update the UI, and set
+    // up the event handlers
     document.addEventListener('DOMContentLoaded', function() {
-        // Check for database id, and initialize storage if it's missing or
-        // different from the expected id
-        var currentId = window.localStorage.getItem('databaseId');
-        if(!currentId || currentId != databaseId) {
-            window.localStorage.setItem('databaseId', databaseId);
-            initLocalStorage();
-        }
+        loadReadInfo(function(loaded) {
+            readInfo = loaded;
 
-        var readInfo = getReadInfo();
-        items().forEach(function(el) {
-            el.classList.toggle('item--unread', isUnread(readInfo, el.dataset.item));
+            items().forEach(function(el) {
+                if(!itemFeeds.has(el.dataset.item)) {
+                    itemFeeds.set(el.dataset.item, el.dataset.feeds.split(' '));
+                }
+                el.classList.toggle('item--unread', isUnread(readInfo, el.dataset.item));
+            });
+            countUnread();
+            uiUnreadCount();
+
+            setupEventHandlers();
         });
-        uiUnreadCount();
     });
 
 }();